@@ -0,0 +1,132 @@
+# ----------------------------------------------------------------------
+# Name:        analytics
+# Purpose:     Reports over a columnar review snapshot written by the
+#              snapshot module. The columns are mapped into memory rather
+#              than read, and every report is computed with vectorized
+#              NumPy operations, so the whole dataset is summarized in
+#              seconds without a query to the database.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+import json
+import os
+
+import numpy as np
+
+from snapshot import (BUSINESS_COLUMNS, EPOCH, MISSING, REVIEW_COLUMNS,
+                      SNAPSHOT_VERSION)
+
+
+# The columns of a snapshot as read-only memory maps, with the lists that
+# decode its dictionary-encoded indexes
+class Snapshot:
+    def __init__(self, directory):
+        with open(os.path.join(directory, "manifest.json")) as file:
+            self.manifest = json.load(file)
+        if self.manifest["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"snapshot version {self.manifest['version']} "
+                             f"is not supported")
+        for name in ("cities", "categories"):
+            with open(os.path.join(directory, f"{name}.json")) as file:
+                setattr(self, name, json.load(file))
+        self.reviews = {column: column_map(directory, column, dtype,
+                                           self.manifest["reviews"])
+                        for column, dtype in REVIEW_COLUMNS.items()}
+        businesses = self.manifest["businesses"]
+        self.city = column_map(directory, "city", BUSINESS_COLUMNS["city"],
+                               businesses)
+        self.category_offsets = column_map(
+            directory, "category_offsets",
+            BUSINESS_COLUMNS["category_offsets"], businesses + 1)
+        self.category_codes = column_map(
+            directory, "categories", BUSINESS_COLUMNS["categories"],
+            int(self.category_offsets[-1]))
+
+    # Mask of the reviews whose business the snapshot knows
+    def known_businesses(self):
+        return self.reviews["business"] != MISSING
+
+
+def column_map(directory, column, dtype, rows):
+    if rows == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(os.path.join(directory, f"{column}.bin"), dtype=dtype,
+                     mode="r", shape=(rows,))
+
+
+# Number of 1 to 5 star reviews in each city, as a dict of city to a list
+# of five counts, busiest city first
+def rating_distribution_by_city(snapshot):
+    known = snapshot.known_businesses()
+    cities = np.asarray(snapshot.city)[snapshot.reviews["business"][known]]
+    stars = np.clip(snapshot.reviews["stars"][known], 1, 5).astype(np.int64)
+    counts = np.bincount(cities * 5 + stars - 1,
+                         minlength=len(snapshot.cities) * 5)
+    counts = counts.reshape(len(snapshot.cities), 5)
+    order = np.argsort(-counts.sum(axis=1), kind="stable")
+    return {snapshot.cities[city]: counts[city].tolist() for city in order
+            if counts[city].any()}
+
+
+# Average review stars and number of reviews of each category, over the
+# reviews of every business listed under it, best rated first. Categories
+# with fewer than min_reviews reviews are left out.
+def average_stars_by_category(snapshot, min_reviews=100):
+    known = snapshot.known_businesses()
+    business = snapshot.reviews["business"][known]
+    businesses = len(snapshot.city)
+    star_totals = np.bincount(business, weights=snapshot.reviews["stars"]
+                              [known], minlength=businesses)
+    review_counts = np.bincount(business, minlength=businesses)
+
+    # Spread each business's totals over its categories
+    owners = np.repeat(np.arange(businesses),
+                       np.diff(snapshot.category_offsets))
+    codes = np.asarray(snapshot.category_codes)
+    category_stars = np.bincount(codes, weights=star_totals[owners],
+                                 minlength=len(snapshot.categories))
+    category_reviews = np.bincount(codes, weights=review_counts[owners],
+                                   minlength=len(snapshot.categories))
+
+    shown = np.flatnonzero(category_reviews >= max(min_reviews, 1))
+    averages = category_stars[shown] / category_reviews[shown]
+    order = np.argsort(-averages, kind="stable")
+    return {snapshot.categories[shown[index]]: {
+                "average_stars": round(float(averages[index]), 2),
+                "reviews": int(category_reviews[shown[index]])}
+            for index in order}
+
+
+# Number of reviews written in each month or year, oldest first
+def review_volume(snapshot, period="month"):
+    if period not in ("month", "year"):
+        raise ValueError("period must be month or year")
+    days = snapshot.reviews["date"]
+    days = days[days != np.iinfo(np.int32).min]
+    dates = (EPOCH + days.astype("timedelta64[D]")).astype(
+        "datetime64[M]" if period == "month" else "datetime64[Y]")
+    periods, counts = np.unique(dates, return_counts=True)
+    return {str(period): int(count)
+            for period, count in zip(periods, counts)}
+
+
+def print_report(snapshot, top=10):
+    print(f"{snapshot.manifest['reviews']} reviews of "
+          f"{snapshot.manifest['businesses']} businesses by "
+          f"{snapshot.manifest['users']} users\n")
+
+    print(f"{'City':<30}{'1':>9}{'2':>9}{'3':>9}{'4':>9}{'5':>9}")
+    for city, counts in list(rating_distribution_by_city(
+            snapshot).items())[:top]:
+        print(f"{city[:29]:<30}" + "".join(f"{count:>9}"
+                                           for count in counts))
+
+    print(f"\n{'Category':<40}{'Average':>9}{'Reviews':>11}")
+    for category, stats in list(average_stars_by_category(
+            snapshot).items())[:top]:
+        print(f"{category[:39]:<40}{stats['average_stars']:>9}"
+              f"{stats['reviews']:>11}")
+
+    print(f"\n{'Year':<10}{'Reviews':>11}")
+    for year, count in review_volume(snapshot, "year").items():
+        print(f"{year:<10}{count:>11}")
@@ -0,0 +1,285 @@
+# ----------------------------------------------------------------------
+# Name:        benchmark
+# Purpose:     Times the numbered queries of the Business Reviews System
+#              against a synthetic dataset. Each query is called with
+#              parameters drawn from the data, and its latency
+#              percentiles, the documents and index keys the server
+#              examined and the round trips it took are reported, as a
+#              table and as JSON that can be diffed across versions.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+from pymongo import MongoClient, monitoring
+from datetime import datetime
+import json
+import random
+import time
+
+from reviews_service import ReviewsService, VOTES
+from synthetic import PASSWORD, generate_dataset, insert_dataset
+
+SAMPLE_SIZE = 200  # businesses and users queries draw their parameters from
+IGNORED_COMMANDS = {"serverStatus", "buildInfo", "endSessions"}
+
+
+# Counts the commands sent to the server, which is one per round trip
+class RoundTripCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name not in IGNORED_COMMANDS:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def business_location(business, zipcode):
+    if zipcode:
+        return {"zipcode": business["postal_code"]}
+    return {"city": business["city"], "state": business["state"]}
+
+
+def search_by_name(zipcode):
+    def query(service, sample, rng):
+        business = rng.choice(sample["businesses"])
+        service.search_businesses(business_location(business, zipcode),
+                                  name=business["name"].split()[-1])
+    return query
+
+
+def search_by_category(zipcode):
+    def query(service, sample, rng):
+        business = rng.choice(sample["businesses"])
+        category = business["categories"].split(", ")[0]
+        service.search_businesses(business_location(business, zipcode),
+                                  category=category)
+    return query
+
+
+def search_by_rating(zipcode):
+    def query(service, sample, rng):
+        business = rng.choice(sample["businesses"])
+        service.search_businesses(business_location(business, zipcode),
+                                  rating=business["stars"])
+    return query
+
+
+def advanced_search(service, sample, rng):
+    business = rng.choice(sample["businesses"])
+    service.search_businesses(business_location(business, zipcode=False),
+                              min_stars=3.5, min_reviews=5, sort="stars")
+
+
+def search_nearby(service, sample, rng):
+    business = rng.choice(sample["businesses"])
+    service.search_businesses({"latitude": business["latitude"],
+                               "longitude": business["longitude"],
+                               "radius_km": 5})
+
+
+def second_page(service, sample, rng):
+    business = rng.choice(sample["businesses"])
+    page = service.business_reviews(business["business_id"])
+    if page["after"]:
+        service.business_reviews(business["business_id"],
+                                 after=page["after"])
+
+
+def create_review(service, sample, rng):
+    user = rng.choice(sample["users"])
+    business = rng.choice(sample["businesses"])
+    review = service.create_review(user["user_id"],
+                                   business["business_id"],
+                                   rng.randint(1, 5), "Benchmark review.")
+    sample["created"].append((user["user_id"], review.review_id))
+
+
+def update_review(service, sample, rng):
+    user_id, review_id = rng.choice(sample["created"])
+    service.update_review(user_id, review_id, rng.randint(1, 5),
+                          "Updated benchmark review.")
+
+
+def delete_review(service, sample, rng):
+    user_id, review_id = sample["created"].pop()
+    service.delete_review(user_id, review_id)
+
+
+# The numbered queries, each a function of the service, the sampled data
+# and a random generator that returns nothing. The writes come last and
+# in order, so that updates and deletes have reviews to work on.
+QUERIES = [
+    ("Login", lambda service, sample, rng: service.login(
+        rng.choice(sample["users"])["name"], PASSWORD)),
+    ("Query 1", lambda service, sample, rng: service.register(
+        f"benchmark-{rng.randrange(10 ** 9)}", PASSWORD)),
+    ("Query 2 & 4", search_by_name(zipcode=False)),
+    ("Query 3 & 4", search_by_name(zipcode=True)),
+    ("Query 2 & 5", search_by_category(zipcode=False)),
+    ("Query 3 & 5", search_by_category(zipcode=True)),
+    ("Query 2 & 6", search_by_rating(zipcode=False)),
+    ("Query 3 & 6", search_by_rating(zipcode=True)),
+    ("Advanced search", advanced_search),
+    ("Nearby search", search_nearby),
+    ("Query 7", lambda service, sample, rng: service.search_users(
+        rng.choice(sample["users"])["name"])),
+    ("Query 8", lambda service, sample, rng: service.leaderboard(
+        "top_rated_businesses")),
+    ("Query 9", lambda service, sample, rng: service.leaderboard(
+        "most_reviewed_businesses")),
+    ("Query 10", lambda service, sample, rng: service.user_reviews(
+        rng.choice(sample["users"])["user_id"])),
+    ("Query 11", lambda service, sample, rng: service.user_profile(
+        rng.choice(sample["users"])["user_id"])),
+    ("Query 12", lambda service, sample, rng: service.business_reviews(
+        rng.choice(sample["businesses"])["business_id"])),
+    ("Query 12 (page 2)", second_page),
+    *[(f"Query {number}", lambda service, sample, rng, vote=vote:
+       service.top_review(rng.choice(sample["businesses"])["business_id"],
+                          vote))
+      for number, vote in zip((13, 14, 15), VOTES)],
+    ("Query 16", lambda service, sample, rng: service.leaderboard(
+        "most_reviews_users")),
+    ("Query 17", lambda service, sample, rng: service.leaderboard(
+        "harshest_critics")),
+    ("Query 18", create_review),
+    ("Query 19", update_review),
+    ("Query 20", delete_review),
+]
+
+
+# Generates a dataset into a scratch database and benchmarks every
+# numbered query against it. Returns the report.
+def run_benchmark(db, businesses=1000, users=5000, reviews=20000, seed=0,
+                  iterations=100, round_trips=None):
+    print(f"Generating {businesses} businesses, {users} users and "
+          f"{reviews} reviews...")
+    db.client.drop_database(db.name)
+    dataset = generate_dataset(businesses, users, reviews, seed)
+    rng = random.Random(seed)
+    sample = {"businesses": rng.sample(dataset["business"],
+                                       min(SAMPLE_SIZE, businesses)),
+              "users": rng.sample(dataset["user"], min(SAMPLE_SIZE, users)),
+              "created": []}
+    insert_dataset(db, dataset)
+
+    service = ReviewsService(db)
+    results = {}
+    for label, query in QUERIES:
+        results[label] = time_query(db, service, query, sample, rng,
+                                    iterations, round_trips)
+        print(format_result(label, results[label]))
+
+    return {"generated_at": datetime.now().isoformat(timespec="seconds"),
+            "server": server_version(db),
+            "dataset": {"businesses": businesses, "users": users,
+                        "reviews": reviews, "seed": seed},
+            "iterations": iterations, "queries": results}
+
+
+# Calls a query the given number of times and summarizes its latencies
+# and, where the server reports them, the work each call cost it. The
+# service's caches are emptied before every call, so each one is timed
+# against the database rather than served from memory.
+def time_query(db, service, query, sample, rng, iterations, round_trips):
+    latencies, errors = [], {}
+    before = examined_counters(db)
+    trips = round_trips.count if round_trips else 0
+    for _ in range(iterations):
+        service.clear_caches()
+        started = time.perf_counter()
+        try:
+            query(service, sample, rng)
+        except Exception as error:
+            message = f"{type(error).__name__}: {error}"
+            errors[message] = errors.get(message, 0) + 1
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+    after = examined_counters(db)
+
+    result = {"calls": len(latencies),
+              **{f"p{percent}_ms": percentile(latencies, percent)
+                 for percent in (50, 95, 99)},
+              "mean_ms": (round(sum(latencies) / len(latencies), 3)
+                          if latencies else None),
+              "docs_examined": None, "keys_examined": None,
+              "round_trips": None}
+    if before and after:
+        for field, counter in (("docs_examined", "scannedObjects"),
+                               ("keys_examined", "scanned")):
+            result[field] = round((after[counter] - before[counter]) /
+                                  iterations, 1)
+    if round_trips:
+        result["round_trips"] = round((round_trips.count - trips) /
+                                      iterations, 2)
+    if errors:
+        result["errors"] = errors
+    return result
+
+
+# The server's running totals of documents and index keys examined by
+# queries, or None where the server does not report them
+def examined_counters(db):
+    try:
+        status = db.client.admin.command("serverStatus")
+        return status["metrics"]["queryExecutor"]
+    except Exception:
+        return None
+
+
+def server_version(db):
+    try:
+        return db.client.server_info()["version"]
+    except Exception:
+        return type(db.client).__module__.split(".")[0]
+
+
+# Nearest-rank percentile of a list of latencies
+def percentile(latencies, percent):
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return round(ordered[int(rank) - 1], 3)
+
+
+def format_result(label, result):
+    if not result["calls"]:
+        return f"{label:<18} failed: {', '.join(result['errors'])}"
+    line = (f"{label:<18} p50 {result['p50_ms']:>8.2f} ms  "
+            f"p95 {result['p95_ms']:>8.2f} ms  "
+            f"p99 {result['p99_ms']:>8.2f} ms")
+    if result["docs_examined"] is not None:
+        line += f"  {result['docs_examined']:>8} docs"
+    if result["round_trips"] is not None:
+        line += f"  {result['round_trips']:>5} trips"
+    return line
+
+
+# Runs the benchmark in the named scratch database of the server at uri
+# and writes its report to output if given. A query that failed makes
+# the whole run fail, without a report, as its timings would be partial.
+def benchmark(uri, database, output=None, **options):
+    if database == "yelp":
+        raise SystemExit("The benchmark drops its database; "
+                         "choose one other than yelp.")
+    round_trips = RoundTripCounter()
+    client = MongoClient(uri, event_listeners=[round_trips])
+    report = run_benchmark(client[database], round_trips=round_trips,
+                           **options)
+    client.close()
+    failed = [label for label, result in report["queries"].items()
+              if result.get("errors")]
+    if failed:
+        raise SystemExit(f"{len(failed)} queries failed "
+                         f"({', '.join(failed)}); no report written.")
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {output}.")
+    return report
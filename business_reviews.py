@@ -10,13 +10,26 @@
 # Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
 # ----------------------------------------------------------------------
 from pymongo import MongoClient
-from datetime import date
-import random
-import string
-import re
-
-
-def main_menu(db):
+from datetime import datetime
+import argparse
+import json
+import os
+import sys
+import time
+
+import instrumentation
+from session import Session
+from reviews_service import (ReviewsService, SEARCH_COUNT_CAP,
+                             backfill_business_search_fields,
+                             backfill_top_reviews, check_query_plans,
+                             ensure_indexes, refresh_leaderboards,
+                             repair_review_stats)
+
+STATS_MONTHS_SHOWN = 12  # latest months of a business's reviews counted
+INGEST_ERRORS_SHOWN = 20  # rejected reviews listed after an ingestion
+
+
+def main_menu(service):
     choice = True
     while choice:
         print(f"{25 * '='} MAIN MENU {25 * '='}")
@@ -28,50 +41,40 @@ def main_menu(db):
         choice = input("Enter your choice: ")
         print()
         if choice == '1':
-            login(db)
+            login(service)
         elif choice == '2':
-            register(db)
+            register(service)
         elif choice == '0':
             choice = False
         else:
             print("Invalid input, please try again\n")
 
 
-def login(db):
+def login(service):
     print(f"{27 * '='} LOGIN {27 * '='}")
     name = input("Enter username: ")
     password = input("Enter password: ")
-    user_count = db.user.count_documents({"name": name, "password": password})
-    user = db.user.find_one({"name": name, "password": password})
-    if user_count:
-        print(f"Hi {user['name']}, you are now logged in!\n")
-        initial_choices(db, user["user_id"])
+    user = service.login(name, password)
+    if user:
+        print(f"Hi {user.name}, you are now logged in!\n")
+        initial_choices(Session(service, user))
     else:
         print("Incorrect username or password. Please try again.\n")
 
 
 # Query 1: Create an account
-def register(db):
+def register(service):
     print(f"{25 * '='} REGISTER {25 * '='}")
-    user_id = generate_id()
     name = input("Enter a username: ")
     password = input("Enter a password: ")
-    creation_date = str(date.today())
-    registered = db.user.insert_one({"user_id": user_id, "name": name,
-                                     "password": password,
-                                     "yelping_since": creation_date,
-                                     "review_count": 0,
-                                     "useful": 0, "funny": 0, "cool": 0,
-                                     "fans": 0,
-                                     "average_stars": 0})
-    if registered.inserted_id:
+    if service.register(name, password):
         print("Account successfully created! Please login...\n")
-        login(db)
+        login(service)
     else:
         print("An error occurred. Please try again.\n")
 
 
-def initial_choices(db, user_id):
+def initial_choices(session):
     choice = True
     while choice:
         print(f"{18 * '='} BUSINESS REVIEWS SYSTEM {18 * '='}")
@@ -82,18 +85,32 @@ def initial_choices(db, user_id):
         choice = input("Enter your choice: ")
         print()
         if choice == '1':
-            search_prompt(db, user_id)
+            search_prompt(session)
         elif choice == '2':
-            view_prompt(db, user_id)
+            view_prompt(session)
         elif choice == '3':
-            review_prompt(db, user_id)
+            review_prompt(session)
         elif choice == '0':
             choice = False
+            print_query_stats(session.service)
         else:
             print("Invalid input, please try again\n")
 
 
-def search_prompt(db, user_id):
+# Prints the database work of the session's queries when instrumented,
+# then starts the next session's count afresh
+def print_query_stats(service):
+    monitor = instrumentation.current_monitor()
+    if monitor and monitor.stats:
+        print(instrumentation.format_summary(monitor.summary()))
+        for name, stats in service.cache_stats().items():
+            print(f"{name} cache: {stats['hits']} hits, "
+                  f"{stats['misses']} misses, {stats['entries']} entries")
+        print()
+        monitor.reset()
+
+
+def search_prompt(session):
     choice = True
     while choice:
         print(f"{26 * '='} SEARCH {27 * '='}")
@@ -103,28 +120,31 @@ def search_prompt(db, user_id):
         choice = input("Enter your choice: ")
         print()
         if choice == '1':
-            search_business_prompt(db, user_id)
+            search_business_prompt(session)
         elif choice == '2':
-            search_users(db)
+            search_users(session.service)
         elif choice == '0':
             choice = False
         else:
             print("Invalid input, please try again\n")
 
 
-def search_business_prompt(db, user_id):
+def search_business_prompt(session):
     choice = True
     while choice:
         print(f"{21 * '='} SEARCH BUSINESSES {21 * '='}")
         print("[1] = Search By City & State\n"
               "[2] = Search By Zipcode\n"
+              "[3] = Search Near A Location\n"
               "[0] = New Search")
         choice = input("Enter your choice: ")
         print()
         if choice == '1':
-            search_business_by_city_state(db, user_id)
+            search_business_by_city_state(session)
         elif choice == '2':
-            search_business_by_zipcode(db, user_id)
+            search_business_by_zipcode(session)
+        elif choice == '3':
+            search_business_nearby(session)
         elif choice == '0':
             choice = False
         else:
@@ -132,36 +152,69 @@ def search_business_prompt(db, user_id):
 
 
 # Query 2: Search for business by city
-def search_business_by_city_state(db, user_id):
+def search_business_by_city_state(session):
     city = input("Enter a city: ")
     state = input("Enter a state abbreviation: ")
     print()
-    search_business_by_attributes_prompt(db, user_id, city=city, state=state)
+    search_business_by_attributes_prompt(session, city=city, state=state)
 
 
 # Query 3: Search for business by zip code
-def search_business_by_zipcode(db, user_id):
+def search_business_by_zipcode(session):
     zipcode = input("Enter a zipcode: ")
     print()
-    search_business_by_attributes_prompt(db, user_id, zipcode=zipcode)
+    search_business_by_attributes_prompt(session, zipcode=zipcode)
+
+
+# Search for businesses nearest a point, optionally within a radius
+def search_business_nearby(session):
+    latitude = prompt_number("Enter a latitude: ")
+    longitude = prompt_number("Enter a longitude: ")
+    radius_km = prompt_number("Enter a radius in km (blank for no limit): ",
+                              optional=True)
+    print()
+    location = {"latitude": latitude, "longitude": longitude}
+    if radius_km is not None:
+        location["radius_km"] = radius_km
+    search_business_by_attributes_prompt(session, **location)
+
+
+def prompt_number(message, optional=False):
+    while True:
+        answer = input(message)
+        if optional and not answer.strip():
+            return None
+        try:
+            return float(answer)
+        except ValueError:
+            print("Please input a number...")
 
 
-def search_business_by_attributes_prompt(db, user_id, **kwargs):
+def search_business_by_attributes_prompt(session, **kwargs):
     choice = True
     while choice:
         print(f"{21 * '='} CHOOSE ATTRIBUTE {22 * '='}")
         print("[1] = Search By Name\n"
               "[2] = Search By Category\n"
               "[3] = Search By Rating\n"
+              "[4] = Suggest Business Names\n"
+              "[5] = Show All Businesses\n"
+              "[6] = Advanced Search\n"
               "[0] = New Search")
         choice = input("Enter your choice: ")
         print()
         if choice == '1':
-            search_business_by_name(db, user_id, **kwargs)
+            search_business_by_name(session, **kwargs)
         elif choice == '2':
-            search_business_by_category(db, user_id, **kwargs)
+            search_business_by_category(session, **kwargs)
         elif choice == '3':
-            search_business_by_rating(db, user_id, **kwargs)
+            search_business_by_rating(session, **kwargs)
+        elif choice == '4':
+            suggest_business_names_prompt(session.service, **kwargs)
+        elif choice == '5':
+            display_business_search(session, kwargs)
+        elif choice == '6':
+            advanced_business_search(session, **kwargs)
         elif choice == '0':
             choice = False
         else:
@@ -169,63 +222,33 @@ def search_business_by_attributes_prompt(db, user_id, **kwargs):
 
 
 # Query 4: Search for business by name
-def search_business_by_name(db, user_id, **kwargs):
+def search_business_by_name(session, **kwargs):
     name = input("Enter a name: ")
     print()
-    regex = re.compile(name, re.IGNORECASE)
-    if "city" in kwargs.keys() and "state" in kwargs.keys():
-        businesses_count = db.business.count_documents({"state": kwargs.get(
-            "state"),
-            "city": kwargs.get("city"),
-            "name": {"$regex": regex}})
-        businesses = db.business.find({"state": kwargs.get("state"),
-                                       "city": kwargs.get("city"),
-                                       "name": {"$regex": regex}})
-    else:
-        businesses_count = db.business.count_documents(
-            {"postal_code": kwargs.get("zipcode"),
-             "name": {"$regex": regex}})
-        businesses = db.business.find({"postal_code": kwargs.get("zipcode"),
-                                       "name": {"$regex": regex}})
-
-    if businesses_count:
-        for business in businesses:
-            display_business(business)
-        view_or_create_reviews_prompt(db, user_id)
+    display_business_search(session, kwargs, name=name)
+
+
+def suggest_business_names_prompt(service, **kwargs):
+    prefix = input("Enter the start of a name: ")
+    print()
+    names = service.suggest_business_names(prefix, kwargs)
+    if names:
+        for name in names:
+            print(name)
+        print()
     else:
         print("No businesses found. Try a different search!\n")
 
 
 # Query 5: Search for business by category
-def search_business_by_category(db, user_id, **kwargs):
+def search_business_by_category(session, **kwargs):
     category = input("Enter a category: ")
     print()
-    regex = re.compile(category, re.IGNORECASE)
-    if "city" in kwargs.keys() and "state" in kwargs.keys():
-        businesses_count = db.business.count_documents(
-            {"state": kwargs.get("state"),
-             "city": kwargs.get("city"),
-             "categories": {"$regex": regex}})
-        businesses = db.business.find({"state": kwargs.get("state"),
-                                       "city": kwargs.get("city"),
-                                       "categories": {"$regex": regex}})
-    else:
-        businesses_count = db.business.count_documents(
-            {"postal_code": kwargs.get("zipcode"),
-             "categories": {"$regex": regex}})
-        businesses = db.business.find({"postal_code": kwargs.get("zipcode"),
-                                       "categories": {"$regex": regex}})
-
-    if businesses_count:
-        for business in businesses:
-            display_business(business)
-        view_or_create_reviews_prompt(db, user_id)
-    else:
-        print("No businesses found. Try a different search!\n")
+    display_business_search(session, kwargs, category=category)
 
 
 # Query 6: Search for business by rating
-def search_business_by_rating(db, user_id, **kwargs):
+def search_business_by_rating(session, **kwargs):
     rating = ""
     while True:
         try:
@@ -236,66 +259,90 @@ def search_business_by_rating(db, user_id, **kwargs):
             print("Please input a number...")
             continue
 
-    if "city" in kwargs.keys() and "state" in kwargs.keys():
-        businesses_count = db.business.count_documents(
-            {"state": kwargs.get("state"),
-             "city": kwargs.get("city"),
-             "stars": rating})
-        businesses = db.business.find({"state": kwargs.get("state"),
-                                       "city": kwargs.get("city"),
-                                       "stars": rating})
-    else:
-        businesses_count = db.business.count_documents(
-            {"postal_code": kwargs.get("zipcode"),
-             "stars": rating})
-        businesses = db.business.find({"postal_code": kwargs.get("zipcode"),
-                                       "stars": rating})
-
-    if businesses_count:
-        for business in businesses:
-            display_business(business)
-        view_or_create_reviews_prompt(db, user_id)
-    else:
-        print("No businesses found. Try a different search!\n")
+    display_business_search(session, kwargs, rating=rating)
+
+
+# Search for businesses matching any mix of name, category, a range of
+# ratings and a minimum number of reviews
+def advanced_business_search(session, **kwargs):
+    print("Leave a filter blank to skip it.")
+    filters = {"name": input("Name: ").strip() or None,
+               "category": input("Category: ").strip() or None,
+               "min_stars": prompt_number("Minimum rating: ", optional=True),
+               "max_stars": prompt_number("Maximum rating: ", optional=True),
+               "min_reviews": prompt_number("Minimum number of reviews: ",
+                                            optional=True)}
+    if filters["min_reviews"] is not None:
+        filters["min_reviews"] = int(filters["min_reviews"])
+    if "latitude" not in kwargs:
+        sorts = {'1': "name", '2': "stars", '3': "review_count"}
+        choice = input("Sort by [1] = Name, [2] = Rating, "
+                       "[3] = Number of Reviews: ")
+        filters["sort"] = sorts.get(choice, "name")
+    print()
+    display_business_search(
+        session, kwargs,
+        **{key: value for key, value in filters.items()
+           if value is not None})
 
 
 # Query 7: Search for users
-def search_users(db):
+def search_users(service):
     name = input("Enter a name: ")
-    users_count = db.user.count_documents({"name": name})
-    if users_count:
-        users = db.user.find({"name": name})
-        for user in users:
-            display_user(user)
+    page = service.search_users(name)
+    if page["results"]:
+        print(f"{count_label(page['count'])} users found.\n")
+        page_through(lambda **bounds: service.search_users(name, **bounds),
+                     display_users, page)
     else:
         print("No users found. Try a different search!\n")
 
 
-def view_or_create_reviews_prompt(db, user_id):
+def display_business_search(session, location, **attributes):
+    page = session.service.search_businesses(location, **attributes)
+    if page["results"]:
+        print(f"{count_label(page['count'])} businesses found.\n")
+        page_through(
+            lambda **bounds: session.service.search_businesses(
+                location, **attributes, **bounds),
+            display_businesses, page)
+        view_or_create_reviews_prompt(session)
+    else:
+        print("No businesses found. Try a different search!\n")
+
+
+def count_label(count):
+    return f"{SEARCH_COUNT_CAP}+" if count > SEARCH_COUNT_CAP else str(count)
+
+
+def view_or_create_reviews_prompt(session):
     choice = True
     while choice:
         print(f"{20 * '='} VIEW OR CREATE REVIEWS {20 * '='}")
         print("[1] = View A Business's Reviews\n"
               "[2] = Give A Review\n"
+              "[3] = Find Similar Businesses\n"
               "[0] = New Search")
         choice = input("Enter your choice: ")
         print()
         if choice == '1':
-            view_business_reviews_prompt(db)
+            view_business_reviews_prompt(session)
         elif choice == '2':
-            create_user_review(db, user_id)
+            create_user_review(session)
+        elif choice == '3':
+            view_similar_businesses(session.service)
         elif choice == '0':
             choice = False
         else:
             print("Invalid input, please try again\n")
 
 
-def view_business_reviews_prompt(db):
+def view_business_reviews_prompt(session):
     not_valid_business = True
     business_id = ""
     while not_valid_business:
         business_id = input("Enter a business id: ")
-        business = get_business(db, business_id)
+        business = session.service.get_business(business_id)
         if business:
             not_valid_business = False
             print()
@@ -304,61 +351,112 @@ def view_business_reviews_prompt(db):
 
     choice = True
     while choice:
-        print(f"{15 * '='} VIEW {business['name']}'s REVIEWS {15 * '='}")
+        print(f"{15 * '='} VIEW {business.name}'s REVIEWS {15 * '='}")
         print("[1] = View All Reviews\n"
               "[2] = View Most Useful Review\n"
               "[3] = View Funniest Review\n"
               "[4] = View Coolest Review\n"
+              "[5] = Vote On A Review\n"
+              "[6] = View Rating Breakdown\n"
               "[0] = Return")
         choice = input("Enter your choice: ")
         print()
         if choice == '1':
-            view_all_business_reviews(db, business_id)
+            view_all_business_reviews(session.service, business_id)
         elif choice == '2':
-            view_most_useful_business_review(db, business_id)
+            view_most_useful_business_review(session.service, business_id)
         elif choice == '3':
-            view_funniest_business_review(db, business_id)
+            view_funniest_business_review(session.service, business_id)
         elif choice == '4':
-            view_coolest_business_review(db, business_id)
+            view_coolest_business_review(session.service, business_id)
+        elif choice == '5':
+            vote_on_review(session)
+        elif choice == '6':
+            view_business_stats(session.service, business_id)
         elif choice == '0':
             choice = False
         else:
             print("Invalid input, please try again\n")
 
 
+# Recommend businesses in the same city like a business
+def view_similar_businesses(service):
+    business_id = input("Enter a business id: ")
+    print()
+    businesses = service.similar_businesses(business_id)
+    if businesses:
+        display_businesses(businesses)
+    else:
+        print("No similar businesses found. Try a different business!\n")
+
+
+# Mark a review as useful, funny or cool
+def vote_on_review(session):
+    review_id = input("Enter a Review ID: ")
+    votes = {'1': "useful", '2': "funny", '3': "cool"}
+    vote = votes.get(input("Vote [1] = Useful, [2] = Funny, [3] = Cool: "))
+    if vote is None:
+        print("Invalid input, please try again\n")
+        return
+    try:
+        voted = session.service.vote(session.user_id, review_id, vote)
+    except ValueError as error:
+        print(f"\n{str(error).capitalize()}.\n")
+        return
+    if voted is None:
+        print("\nNo review found. Try a different search!\n")
+    elif voted:
+        print(f"\nYou voted this review {vote}!\n")
+    else:
+        print(f"\nYou have already voted this review {vote}.\n")
+
+
+# View how many reviews gave a business each rating, and how many it
+# received in each of its latest months
+def view_business_stats(service, business_id):
+    stats = service.business_stats(business_id)
+    if not stats:
+        return
+    most = max(stats.stars) or 1
+    for rating in range(5, 0, -1):
+        count = stats.stars[rating - 1]
+        label = f"{rating} star{'s' if rating > 1 else ''}:"
+        print(f"{label:<9}{'#' * round(40 * count / most):<40} {count}")
+    print()
+    for month, count in list(stats.months.items())[-STATS_MONTHS_SHOWN:]:
+        print(f"{month}: {count} reviews")
+    print()
+
+
 # Query 12: View a business's reviews
-def view_all_business_reviews(db, business_id):
-    reviews = db.review.find({"business_id": business_id})
-    for review in reviews:
-        display_review(db, review)
-        print("----------------------------------------\n")
+def view_all_business_reviews(service, business_id):
+    page_through(
+        lambda **bounds: service.business_reviews(business_id, **bounds),
+        lambda reviews: display_reviews(reviews, separator=True))
 
 
 # Query 13: View most useful review of a business
-def view_most_useful_business_review(db, business_id):
-    reviews = db.review.find({"business_id": business_id}).sort("useful",
-                                                                -1).limit(1)
-    for review in reviews:
-        display_review(db, review)
+def view_most_useful_business_review(service, business_id):
+    review = service.top_review(business_id, "useful")
+    if review:
+        display_review(review)
 
 
 # Query 14: View funniest review of a business
-def view_funniest_business_review(db, business_id):
-    reviews = db.review.find({"business_id": business_id}).sort("funny",
-                                                                -1).limit(1)
-    for review in reviews:
-        display_review(db, review)
+def view_funniest_business_review(service, business_id):
+    review = service.top_review(business_id, "funny")
+    if review:
+        display_review(review)
 
 
 # Query 15: View coolest review of a business
-def view_coolest_business_review(db, business_id):
-    reviews = db.review.find({"business_id": business_id}).sort("cool",
-                                                                -1).limit(1)
-    for review in reviews:
-        display_review(db, review)
+def view_coolest_business_review(service, business_id):
+    review = service.top_review(business_id, "cool")
+    if review:
+        display_review(review)
 
 
-def view_prompt(db, user_id):
+def view_prompt(session):
     choice = True
     while choice:
         print(f"{27 * '='} VIEW {27 * '='}")
@@ -371,15 +469,15 @@ def view_prompt(db, user_id):
         choice = input("Enter your choice: ")
         print()
         if choice == '1':
-            view_user_profile(db, user_id)
+            view_user_profile(session)
         elif choice == '2':
-            view_top_rated_businesses(db)
+            view_top_rated_businesses(session.service)
         elif choice == '3':
-            view_most_rated_businesses(db)
+            view_most_rated_businesses(session.service)
         elif choice == '4':
-            view_user_most_reviews(db)
+            view_user_most_reviews(session.service)
         elif choice == '5':
-            view_user_lowest_average_rating(db)
+            view_user_lowest_average_rating(session.service)
         elif choice == '0':
             choice = False
         else:
@@ -387,45 +485,40 @@ def view_prompt(db, user_id):
 
 
 # Query 11: View your account profile
-def view_user_profile(db, user_id):
-    user = db.user.find_one({"user_id": user_id})
-    display_user(user)
+def view_user_profile(session):
+    display_user(session.user)
 
 
 # Query 8: View top 10 businesses
-def view_top_rated_businesses(db):
-    businesses = db.business.find({"stars": 5,
-                                   "review_count": {"$gte": 100}}).sort(
-        "stars", -1).limit(10)
+def view_top_rated_businesses(service):
+    businesses = service.leaderboard("top_rated_businesses")
     for count, business in enumerate(businesses):
         print("#" + str(count + 1))
         display_business(business)
 
 
 # Query 9: View most reviewed business
-def view_most_rated_businesses(db):
-    businesses = db.business.find().sort("review_count", -1).limit(1)
+def view_most_rated_businesses(service):
+    businesses = service.leaderboard("most_reviewed_businesses")
     for business in businesses:
         display_business(business)
 
 
 # Query 16: View user with the most reviews
-def view_user_most_reviews(db):
-    users = db.user.find().sort("review_count", -1).limit(1)
+def view_user_most_reviews(service):
+    users = service.leaderboard("most_reviews_users")
     for user in users:
         display_user(user)
 
 
 # Query 17: View user that is the harshest critic
-def view_user_lowest_average_rating(db):
-    users = db.user.find({"review_count": {"$gt": 100},
-                          "average_stars": {"$exists": True}}).sort(
-        "average_stars", 1).limit(1)
+def view_user_lowest_average_rating(service):
+    users = service.leaderboard("harshest_critics")
     for user in users:
         display_user(user)
 
 
-def review_prompt(db, user_id):
+def review_prompt(session):
     choice = True
     while choice:
         print(f"{25 * '='} MY REVIEWS {24 * '='}")
@@ -437,13 +530,13 @@ def review_prompt(db, user_id):
         choice = input("Enter your choice: ")
         print()
         if choice == '1':
-            view_user_reviews(db, user_id)
+            view_user_reviews(session)
         elif choice == '2':
-            create_user_review(db, user_id)
+            create_user_review(session)
         elif choice == '3':
-            update_user_review(db, user_id)
+            update_user_review(session)
         elif choice == '4':
-            delete_user_review(db, user_id)
+            delete_user_review(session)
         elif choice == '0':
             choice = False
         else:
@@ -451,43 +544,25 @@ def review_prompt(db, user_id):
 
 
 # Query 10: View all reviews made by your account
-def view_user_reviews(db, user_id):
-    reviews = db.review.find({"user_id": user_id})
-    if reviews:
-        for review in reviews:
-            display_review(db, review)
-    else:
+def view_user_reviews(session):
+    if not page_through(
+            lambda **bounds: session.service.user_reviews(session.user_id,
+                                                          **bounds),
+            display_reviews):
         print("You haven't made any reviews!\n")
 
 
 # Query 18: Create a review for a business
-def create_user_review(db, user_id):
+def create_user_review(session):
     business_id = input("Enter a Business ID: ")
-    business = get_business(db, business_id)
+    business = session.service.get_business(business_id)
     if business:
         stars = 0
         while stars < 1 or stars > 5:
             stars = int(input("Rate this business (1 - 5): "))
         text = input("Write your review: ")
-        review_id = generate_id()
-        review_date = str(date.today())
-        created = db.review.insert_one({"review_id": review_id,
-                                        "user_id": user_id,
-                                        "business_id": business_id,
-                                        "stars": stars,
-                                        "date": review_date,
-                                        "text": text})
-
-        if created.inserted_id:
-            db.user.update_one({"user_id": user_id}, {"$inc": {
-                "review_count": 1}})
-            my_reviews = db.review.find({"user_id": user_id})
-            average = 0
-            for review in my_reviews:
-                average += int(review['stars'])
-            average /= db.review.count_documents({"user_id": user_id})
-            db.user.update_one({"user_id": user_id},
-                               {"$set": {"average_stars": average}})
+
+        if session.create_review(business_id, stars, text):
             print("\nReview successfully made!\n")
         else:
             print("\nAn error occurred. Please try again.\n")
@@ -496,27 +571,17 @@ def create_user_review(db, user_id):
 
 
 # Query 19: Update a review you made for a business
-def update_user_review(db, user_id):
+def update_user_review(session):
     review_id = input("Enter a Review ID: ")
-    review = db.review.find_one({"review_id": review_id, "user_id": user_id})
+    review = session.service.get_review(session.user_id, review_id)
     if review:
-        display_review(db, review)
-        updated_stars = input("Enter a new rating (1 - 5): ")
+        display_review(review)
+        updated_stars = 0
+        while updated_stars < 1 or updated_stars > 5:
+            updated_stars = int(input("Enter a new rating (1 - 5): "))
         updated_text = input("Enter your updated review: ")
-        updated_date = str(date.today())
-        updated = db.review.update_one({"review_id": review_id},
-                                       {"$set": {"stars": updated_stars,
-                                                 "date": updated_date,
-                                                 "text": updated_text}})
-
-        if updated.modified_count:
-            my_reviews = db.review.find({"user_id": user_id})
-            average = 0
-            for r in my_reviews:
-                average += int(r['stars'])
-            average /= db.review.count_documents({"user_id": user_id})
-            db.user.update_one({"user_id": user_id},
-                               {"$set": {"average_stars": average}})
+
+        if session.update_review(review_id, updated_stars, updated_text):
             print("\nReview successfully updated!\n")
         else:
             print("\nUpdate failed. Please try again.\n")
@@ -525,25 +590,10 @@ def update_user_review(db, user_id):
 
 
 # Query 20: Delete a review you made for a business
-def delete_user_review(db, user_id):
+def delete_user_review(session):
     review_id = input("Enter a Review ID: ")
-    review = db.review.find_one({"review_id": review_id, "user_id": user_id})
-    if review:
-        deleted = db.review.delete_one({"review_id": review_id})
-
-        if deleted.deleted_count:
-            db.user.update_one({"user_id": user_id},
-                               {"$inc": {"review_count": -1}})
-
-            my_reviews = db.review.find({"user_id": user_id})
-            total_reviews = db.review.count_documents({"user_id": user_id})
-            average = 0
-            if total_reviews:
-                for review in my_reviews:
-                    average += int(review['stars'])
-                average /= total_reviews
-            db.user.update_one({"user_id": user_id},
-                               {"$set": {"average_stars": average}})
+    if session.service.get_review(session.user_id, review_id):
+        if session.delete_review(review_id):
             print("\nReview successfully deleted!\n")
         else:
             print("\nDelete failed. Please try again.\n")
@@ -551,67 +601,343 @@ def delete_user_review(db, user_id):
         print("No review found. Try a different search!\n")
 
 
-def get_business(db, business_id):
-    return db.business.find_one({"business_id": business_id})
+# Lets the user step forwards and backwards through a listing one page at
+# a time. fetch accepts the after/before page tokens of the service's
+# listings; first_page may carry a page the caller already has.
+# Returns False if the listing is empty.
+def page_through(fetch, display_page, first_page=None):
+    page = first_page if first_page else fetch()
+    if not page["results"]:
+        return False
+    display_page(page["results"])
+    number, has_next, has_previous = 1, page["has_more"], False
+
+    while has_next or has_previous:
+        print(f"{25 * '='} PAGE {number} {25 * '='}")
+        if has_next:
+            print("[1] = Next Page")
+        if has_previous:
+            print("[2] = Previous Page")
+        print("[0] = Done")
+        choice = input("Enter your choice: ")
+        print()
+        if choice == '1' and has_next:
+            next_page = fetch(after=page["after"])
+            has_next = next_page["has_more"]
+            if next_page["results"]:
+                page, number, has_previous = next_page, number + 1, True
+                display_page(page["results"])
+            else:
+                print("No more results.\n")
+        elif choice == '2' and has_previous:
+            previous_page = fetch(before=page["before"])
+            has_previous = previous_page["has_more"]
+            if previous_page["results"]:
+                page, number, has_next = previous_page, number - 1, True
+                display_page(page["results"])
+        elif choice == '0':
+            break
+        else:
+            print("Invalid input, please try again\n")
+    return True
 
 
-def display_review(db, review):
-    user = db.user.find_one({"user_id": review['user_id']})
-    business = get_business(db, review["business_id"])
-    print(f"Review ID: {review['review_id']}\n"
-          f"User: {user['name']} (ID: {user['user_id']})\n"
-          f"Business: {business['name']} (ID: {business['business_id']})\n"
-          f"Date: {review['date']}\n"
-          f"Rating: {review['stars']}\n"
-          f"Useful: {review.get('useful', 0)} votes\n"
-          f"Funny: {review.get('funny', 0)} votes\n"
-          f"Cool: {review.get('cool', 0)} votes\n"
-          f"Review: {review['text']}\n")
+def display_reviews(reviews, separator=False):
+    for review in reviews:
+        display_review(review)
+        if separator:
+            print("----------------------------------------\n")
+
+
+def display_review(review):
+    text = review.text + ("..." if review.truncated else "")
+    print(f"Review ID: {review.review_id}\n"
+          f"User: {review.user_name} (ID: {review.user_id})\n"
+          f"Business: {review.business_name} (ID: {review.business_id})\n"
+          f"Date: {review.date}\n"
+          f"Rating: {review.stars}\n"
+          f"Useful: {review.useful} votes\n"
+          f"Funny: {review.funny} votes\n"
+          f"Cool: {review.cool} votes\n"
+          f"Review: {text}\n")
+
+
+def display_users(users):
+    for user in users:
+        display_user(user)
 
 
 def display_user(user):
-    print(f"User: {user['name']} (ID: {user['user_id']})\n"
-          f"User Since: {user['yelping_since']}\n"
-          f"Number of Reviews: {user['review_count']}\n"
-          f"Number of Useful Reviews: {user['useful']}\n"
-          f"Number of Funny Reviews: {user['funny']}\n"
-          f"Number of Cool Reviews: {user['cool']}\n"
-          f"Number of Fans: {user['fans']}\n"
-          f"Average Rating of All Reviews: {user['average_stars']}\n")
+    print(f"User: {user.name} (ID: {user.user_id})\n"
+          f"User Since: {user.yelping_since}\n"
+          f"Number of Reviews: {user.review_count}\n"
+          f"Number of Useful Reviews: {user.useful}\n"
+          f"Number of Funny Reviews: {user.funny}\n"
+          f"Number of Cool Reviews: {user.cool}\n"
+          f"Number of Fans: {user.fans}\n"
+          f"Average Rating of All Reviews: {user.average_stars}\n")
+
+
+def display_businesses(businesses):
+    for business in businesses:
+        display_business(business)
 
 
 def display_business(business):
-    print(f"Business: {business['name']} (ID: {business['business_id']})\n"
-          f"Address: {business.get('address', 'N/A')}, {business['city']}, "
-          f"{business['state']}, {business['postal_code']}\n"
-          f"Categories: {business['categories']}\n"
-          f"Average Rating: {business['stars']}\n"
-          f"Number of Reviews: {business['review_count']}\n")
+    print(f"Business: {business.name} (ID: {business.business_id})\n"
+          f"Address: {business.address or 'N/A'}, {business.city}, "
+          f"{business.state}, {business.postal_code}\n"
+          f"Categories: {business.categories}\n"
+          f"Average Rating: {business.stars}\n"
+          f"Number of Reviews: {business.review_count}")
+    if business.distance is not None:
+        print(f"Distance: {business.distance} km")
+    print()
 
 
-def generate_id():
-    return ''.join(random.choice(string.ascii_letters) for i in range(22))
+# Writes the reviews of an NDJSON file and lists any it rejected by line
+def ingest_reviews(service, path):
+    numbers, rejected = [], []
+    with open(path) as file:
+        result = service.ingest_reviews(read_reviews(file, numbers,
+                                                     rejected))
+    rejected += [{"line": numbers[rejection["index"]],
+                  "error": rejection["error"]}
+                 for rejection in result["rejected"]]
+    rejected.sort(key=lambda rejection: rejection["line"])
+    print(f"{result['inserted']} reviews written, {len(rejected)} rejected.")
+    for rejection in rejected[:INGEST_ERRORS_SHOWN]:
+        print(f"Line {rejection['line']}: {rejection['error']}")
+
+
+# Parses the lines of an NDJSON file of reviews one at a time, skipping
+# blank ones. The number of each line parsed is added to numbers; lines
+# that are not valid JSON are added to rejected instead.
+def read_reviews(file, numbers, rejected):
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            review = json.loads(line)
+        except ValueError:
+            rejected.append({"line": number, "error": "not valid JSON"})
+            continue
+        numbers.append(number)
+        yield review
 
 
 def main():
-    client = MongoClient('mongodb://localhost:27017/')
+    parser = argparse.ArgumentParser(prog="business_reviews")
+    parser.add_argument("--uri", default="mongodb://localhost:27017/",
+                        help="MongoDB connection string")
+    parser.add_argument("--instrument", action="store_true",
+                        help="record the database work of every query")
+    parser.add_argument("--slow-ms", type=float, default=100,
+                        help="log commands slower than this when "
+                             "instrumented")
+    parser.add_argument("--slow-log", default="slow_queries.log",
+                        help="file slow commands are logged to")
+    parser.add_argument("--similarity", default="business_similarity",
+                        help="directory of the similar business vectors")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("repair-stats",
+                        help="recompute review counts and average ratings "
+                             "from the review collection")
+    commands.add_parser("backfill-search",
+                        help="compute the indexed search fields of every "
+                             "business")
+    commands.add_parser("check-plans",
+                        help="explain every numbered query and fail if any "
+                             "scans a collection or sorts in memory")
+    refresh = commands.add_parser("refresh-leaderboards",
+                                  help="recompute the View menu leaderboards")
+    refresh.add_argument("--every", type=int, metavar="SECONDS",
+                         help="keep refreshing at this interval")
+    commands.add_parser("backfill-top-reviews",
+                        help="point every business at its most useful, "
+                             "funniest and coolest reviews")
+    load = commands.add_parser("load",
+                               help="load the Yelp dataset's NDJSON files")
+    for collection in ("business", "user", "review"):
+        load.add_argument(f"--{collection}", metavar="PATH",
+                          help=f"{collection} file to load")
+    load.add_argument("--batch-size", type=int, default=1000,
+                      help="documents per insert")
+    load.add_argument("--workers", type=int, default=4,
+                      help="batches written concurrently")
+    load.add_argument("--checkpoint", default="load_checkpoint.json",
+                      help="file recording progress, to resume a load")
+    serve = commands.add_parser("serve",
+                                help="serve the queries as a JSON HTTP API")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.add_argument("--workers", type=int, default=32,
+                       help="queries run concurrently")
+    generate = commands.add_parser("generate",
+                                   help="write a synthetic Yelp-shaped "
+                                        "dataset for the load command")
+    benchmark = commands.add_parser("benchmark",
+                                    help="time every numbered query against "
+                                         "a synthetic dataset")
+    load_test = commands.add_parser("load-test",
+                                    help="replay concurrent menu sessions "
+                                         "against a synthetic dataset")
+    for command in (generate, benchmark, load_test):
+        command.add_argument("--businesses", type=int, default=1000)
+        command.add_argument("--users", type=int, default=5000)
+        command.add_argument("--reviews", type=int, default=20000)
+        command.add_argument("--seed", type=int, default=0)
+    generate.add_argument("--output", default="synthetic_data",
+                          help="directory to write the NDJSON files to")
+    benchmark.add_argument("--iterations", type=int, default=100,
+                           help="calls timed per query")
+    benchmark.add_argument("--database", default="yelp_benchmark",
+                           help="scratch database, dropped before the run")
+    benchmark.add_argument("--output", metavar="PATH",
+                           help="file to write the JSON report to")
+    load_test.add_argument("--sessions", type=int, default=500,
+                           help="menu sessions replayed")
+    load_test.add_argument("--workers", type=int,
+                           help="processes replaying sessions at once "
+                                "(default: one per CPU)")
+    load_test.add_argument("--database", default="yelp_load_test",
+                           help="scratch database, dropped before the run")
+    load_test.add_argument("--output", metavar="PATH",
+                           help="file to write the JSON report to")
+    export = commands.add_parser("export-snapshot",
+                                 help="write the reviews as columnar files "
+                                      "for the report command")
+    export.add_argument("--output", default="review_snapshot",
+                        help="directory to write the snapshot to")
+    ingest = commands.add_parser("ingest-reviews",
+                                 help="write the reviews of a partner feed "
+                                      "or migration in bulk")
+    ingest.add_argument("path",
+                        help="NDJSON file of reviews, each with user_id, "
+                             "business_id, stars and text")
+    commands.add_parser("build-similarity",
+                        help="encode every business for the similar "
+                             "business recommendations")
+    report = commands.add_parser("report",
+                                 help="summarize a review snapshot without "
+                                      "querying the database")
+    report.add_argument("--snapshot", default="review_snapshot",
+                        help="directory of the snapshot")
+    report.add_argument("--top", type=int, default=10,
+                        help="cities and categories listed")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        from analytics import Snapshot, print_report
+        print_report(Snapshot(args.snapshot), args.top)
+        return
+
+    if args.command == "generate":
+        from synthetic import generate_dataset, write_dataset
+        write_dataset(args.output, generate_dataset(
+            args.businesses, args.users, args.reviews, args.seed))
+        print(f"Dataset written to {args.output}.")
+        return
+    if args.command == "benchmark":
+        from benchmark import benchmark
+        benchmark(args.uri, args.database, args.output,
+                  businesses=args.businesses, users=args.users,
+                  reviews=args.reviews, seed=args.seed,
+                  iterations=args.iterations)
+        return
+    if args.command == "load-test":
+        from load_test import load_test
+        report = load_test(args.uri, args.database, args.output,
+                           sessions=args.sessions, workers=args.workers,
+                           businesses=args.businesses, users=args.users,
+                           reviews=args.reviews, seed=args.seed)
+        sys.exit(1 if any(drift["drifted"] for drift
+                          in report["drift"].values()) else 0)
+
+    listeners = []
+    if args.instrument:
+        listeners.append(instrumentation.install(args.slow_ms,
+                                                 args.slow_log))
+    client = MongoClient(args.uri, event_listeners=listeners)
     db = client.yelp  # yelp = name of our database
-    print("Loading database and indexes...\n")
 
-    db.business.create_index([("business_id", 1)], unique=True)
-    db.business.create_index([("state", 1), ("city", 1)])
-    db.business.create_index([("zipcode", 1)])
-    db.business.create_index([("review_count", 1)])
+    if args.command == "repair-stats":
+        print("Recomputing review statistics...")
+        repair_review_stats(db)
+        print("Review statistics and leaderboards repaired.")
+        return
+    if args.command == "backfill-search":
+        print("Backfilling business search fields...")
+        updated = backfill_business_search_fields(db)
+        print(f"Updated {updated} businesses.")
+        return
+    if args.command == "load":
+        from loader import load_dataset
+        load_dataset(db, {"business": args.business, "user": args.user,
+                          "review": args.review},
+                     batch_size=args.batch_size, workers=args.workers,
+                     checkpoint_path=args.checkpoint)
+        print("Computing top reviews and leaderboards...")
+        backfill_top_reviews(db)
+        refresh_leaderboards(db)
+        print("Load complete.")
+        return
+    if args.command == "export-snapshot":
+        from snapshot import export_snapshot
+        rows = export_snapshot(db, args.output)
+        print(f"Snapshot of {rows} reviews written to {args.output}.")
+        return
+    if args.command == "build-similarity":
+        from similarity import build_similarity
+        count = build_similarity(db, args.similarity)
+        print(f"Vectors of {count} businesses written to "
+              f"{args.similarity}.")
+        return
+    if args.command == "backfill-top-reviews":
+        print("Computing top reviews...")
+        backfill_top_reviews(db)
+        print("Top reviews computed.")
+        return
+    if args.command == "refresh-leaderboards":
+        while True:
+            refresh_leaderboards(db)
+            print(f"Leaderboards refreshed at {datetime.now():%H:%M:%S}.")
+            if not args.every:
+                return
+            time.sleep(args.every)
+    if args.command == "check-plans":
+        ensure_indexes(db, wait=True)
+        sys.exit(0 if check_query_plans(db) else 1)
 
-    db.user.create_index([("user_id", 1)], unique=True)
-    db.user.create_index([("name", 1)])
-    db.user.create_index([("review_count", 1)])
-
-    db.review.create_index([("review_id", 1)], unique=True)
-    db.review.create_index([("business_id", 1)])
-    db.review.create_index([("user_id", 1)])
-
-    main_menu(db)
+    print("Loading database and indexes...\n")
+    missing = ensure_indexes(db)
+    if missing:
+        print(f"Building {sum(map(len, missing.values()))} missing indexes "
+              f"in the background...\n")
+
+    similar = None
+    if os.path.isdir(args.similarity):
+        from similarity import SimilarBusinesses
+        similar = SimilarBusinesses(args.similarity)
+    service = ReviewsService(db, similar=similar)
+    if args.command == "ingest-reviews":
+        try:
+            ingest_reviews(service, args.path)
+        finally:
+            service.close()
+        return
+    if args.command == "serve":
+        from reviews_server import serve
+        try:
+            serve(service, args.host, args.port, args.workers)
+        finally:
+            service.close()
+        return
+
+    try:
+        main_menu(service)
+    finally:
+        service.close()
     print("Thanks for using the Business Reviews System! Goodbye!\n")
 
 
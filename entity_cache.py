@@ -0,0 +1,108 @@
+# ----------------------------------------------------------------------
+# Name:        entity_cache
+# Purpose:     A bounded in-process cache of business and user documents,
+#              so that the entities every screen shows again and again
+#              are read from memory instead of the database. Entries
+#              expire after a time to live and the least recently used
+#              are evicted once the cache holds more bytes than allowed.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+from collections import OrderedDict
+import threading
+import time
+
+import bson
+
+CACHE_TTL = 60  # seconds before a cached document is read again
+CACHE_MAX_BYTES = 16 * 1024 * 1024  # BSON bytes held by each cache
+
+
+# Documents keyed by their id, most recently used last. Callers get and
+# put copies, so a cached document is never changed in place.
+class EntityCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[2])
+
+    # Looks up many keys at once, returning the cached documents by key
+    # and the keys that missed
+    def get_many(self, keys):
+        found, missing = {}, []
+        for key in keys:
+            document = self.get(key)
+            if document is None:
+                missing.append(key)
+            else:
+                found[key] = document
+        return found, missing
+
+    def put(self, key, document):
+        size = len(bson.encode(document))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, size,
+                                 dict(document))
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    # Replaces a cached document with change(document), keeping its
+    # expiry; does nothing if the key is not cached. change gets a copy,
+    # and must copy any list or dict in it that it alters.
+    def update(self, key, change):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return
+            document = change(dict(entry[2]))
+            size = len(bson.encode(document))
+            self.entries[key] = (entry[0], size, document)
+            self.bytes += size - entry[1]
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "bytes": self.bytes,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3)
+                    if lookups else None,
+                    "evictions": self.evictions}
+
+    def _remove(self, key):
+        self.bytes -= self.entries.pop(key)[1]
@@ -0,0 +1,241 @@
+# ----------------------------------------------------------------------
+# Name:        instrumentation
+# Purpose:     Opt-in accounting of the database work behind each of the
+#              numbered queries. A pymongo command listener attributes
+#              every command to the query that issued it and records the
+#              durations, documents returned and round trips in
+#              in-process histograms. Commands slower than a threshold
+#              are written to a slow-query log.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+from pymongo import monitoring
+import bisect
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+
+UNATTRIBUTED = "(unattributed)"  # commands issued outside any query
+SLOW_QUERY_COMMAND_LENGTH = 500  # characters of a command logged as slow
+
+# Upper bounds of the histogram buckets; larger values fall in a last,
+# unbounded bucket
+LATENCY_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+                     1000, 2500, 5000, 10000)
+COUNT_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+
+# Fields of a command that say nothing about the query it runs
+COMMAND_NOISE = ("lsid", "$db", "$clusterTime", "$readPreference",
+                 "txnNumber", "documents")
+
+slow_query_log = logging.getLogger("business_reviews.slow_queries")
+
+_monitor = None
+_current_call = contextvars.ContextVar("current_call", default=None)
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    # Upper bound of the bucket holding the given percentile, or the
+    # largest value seen for the unbounded bucket
+    def percentile(self, percent):
+        rank = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count,
+                "mean": round(self.total / self.count, 3),
+                **{f"p{percent}": round(self.percentile(percent), 3)
+                   for percent in (50, 95, 99)},
+                "max": round(self.max, 3)}
+
+
+# One call of a numbered query and the commands it has issued so far
+class QueryCall:
+    def __init__(self, label):
+        self.label = label
+        self.started = time.perf_counter()
+        self.round_trips = 0
+        self.documents = 0
+
+
+class QueryStats:
+    def __init__(self):
+        self.latency_ms = Histogram(LATENCY_BOUNDS_MS)
+        self.round_trips = Histogram(COUNT_BOUNDS)
+        self.documents = Histogram(COUNT_BOUNDS)
+        self.commands = {}
+        self.failed_commands = 0
+
+    def summary(self):
+        return {"latency_ms": self.latency_ms.summary(),
+                "round_trips": self.round_trips.summary(),
+                "documents": self.documents.summary(),
+                "commands": {name: histogram.summary()
+                             for name, histogram in self.commands.items()},
+                "failed_commands": self.failed_commands}
+
+
+# Listens to every command a client sends. Listener callbacks run on the
+# thread that issued the command, so the query being run is read from a
+# context variable when a command starts and carried to its completion.
+class QueryMonitor(monitoring.CommandListener):
+    def __init__(self, slow_ms=100):
+        self.slow_ms = slow_ms
+        self.stats = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        self.pending[(event.connection_id, event.request_id)] = (
+            _current_call.get(), event.command)
+
+    def succeeded(self, event):
+        call, command = self.pending.pop(
+            (event.connection_id, event.request_id), (None, None))
+        documents = returned_documents(event.command_name, event.reply)
+        duration_ms = event.duration_micros / 1000
+        if call:
+            call.round_trips += 1
+            call.documents += documents
+        label = call.label if call else UNATTRIBUTED
+        with self.lock:
+            stats = self.query_stats(label)
+            stats.commands.setdefault(
+                event.command_name,
+                Histogram(LATENCY_BOUNDS_MS)).add(duration_ms)
+        if duration_ms >= self.slow_ms:
+            log_slow_command(label, event.command_name, duration_ms,
+                             documents, command)
+
+    def failed(self, event):
+        call, _ = self.pending.pop((event.connection_id, event.request_id),
+                                   (None, None))
+        if call:
+            call.round_trips += 1
+        with self.lock:
+            self.query_stats(call.label if call else UNATTRIBUTED) \
+                .failed_commands += 1
+
+    def record_call(self, call):
+        latency_ms = (time.perf_counter() - call.started) * 1000
+        with self.lock:
+            stats = self.query_stats(call.label)
+            stats.latency_ms.add(latency_ms)
+            stats.round_trips.add(call.round_trips)
+            stats.documents.add(call.documents)
+
+    def query_stats(self, label):
+        if label not in self.stats:
+            self.stats[label] = QueryStats()
+        return self.stats[label]
+
+    def summary(self):
+        with self.lock:
+            return {label: stats.summary()
+                    for label, stats in sorted(self.stats.items())}
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+
+# Turns instrumentation on, writing commands slower than slow_ms to the
+# slow-query log at slow_log. Returns the listener to pass to MongoClient.
+def install(slow_ms=100, slow_log="slow_queries.log"):
+    global _monitor
+    if slow_log and not slow_query_log.handlers:
+        handler = logging.FileHandler(slow_log)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_query_log.addHandler(handler)
+        slow_query_log.setLevel(logging.INFO)
+        slow_query_log.propagate = False
+    _monitor = QueryMonitor(slow_ms)
+    return _monitor
+
+
+def current_monitor():
+    return _monitor
+
+
+# Attributes the commands a function issues to a numbered query. label is
+# the query's name, or a function of the call's arguments returning it.
+# Without a monitor installed the function is called directly, and so is
+# one called from within another query, whose commands count towards the
+# outer query.
+def query(label):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _monitor is None or _current_call.get() is not None:
+                return function(*args, **kwargs)
+            call = QueryCall(label(*args, **kwargs) if callable(label)
+                             else label)
+            token = _current_call.set(call)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _current_call.reset(token)
+                _monitor.record_call(call)
+        return wrapper
+    return decorate
+
+
+# Number of documents a command's reply carries or reports writing
+def returned_documents(command_name, reply):
+    if "cursor" in reply:
+        cursor = reply["cursor"]
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", ())))
+    if command_name == "findAndModify":
+        return 1 if reply.get("value") else 0
+    return reply.get("n", 0)
+
+
+def log_slow_command(label, command_name, duration_ms, documents, command):
+    details = {field: value for field, value in (command or {}).items()
+               if field not in COMMAND_NOISE}
+    text = json.dumps(details, default=str)
+    if len(text) > SLOW_QUERY_COMMAND_LENGTH:
+        text = text[:SLOW_QUERY_COMMAND_LENGTH] + "..."
+    slow_query_log.info(f"{duration_ms:.1f} ms {label}: {command_name} "
+                        f"returned {documents} documents {text}")
+
+
+def format_summary(summary):
+    lines = [f"{'Query':<24}{'calls':>7}{'p50 ms':>9}{'p95 ms':>9}"
+             f"{'p99 ms':>9}{'trips':>7}{'docs':>8}"]
+    for label, stats in summary.items():
+        latency = stats["latency_ms"]
+        if not latency["count"]:
+            commands = sum(histogram["count"]
+                           for histogram in stats["commands"].values())
+            lines.append(f"{label:<24}{commands:>7} commands")
+            continue
+        lines.append(f"{label:<24}{latency['count']:>7}"
+                     f"{latency['p50']:>9.2f}{latency['p95']:>9.2f}"
+                     f"{latency['p99']:>9.2f}"
+                     f"{stats['round_trips']['mean']:>7.1f}"
+                     f"{stats['documents']['mean']:>8.1f}")
+    return "\n".join(lines)
@@ -0,0 +1,283 @@
+# ----------------------------------------------------------------------
+# Name:        load_test
+# Purpose:     Replays scripted menu sessions against a MongoDB server
+#              from a pool of worker processes, the way many users at
+#              once log in, search, read reviews and write their own.
+#              Reports the throughput, latency percentiles and error
+#              rates of each menu action, then checks that the running
+#              review counts and star totals of every user and business
+#              the sessions wrote to still match their reviews.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+from pymongo import MongoClient
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import random
+import time
+
+from benchmark import percentile, server_version
+from reviews_service import ReviewsService, VOTES
+from session import Session
+from synthetic import PASSWORD, generate_dataset, insert_dataset, \
+    zipf_choices
+
+WRITE_SHARE = 0.5  # sessions that create a review
+UPDATE_SHARE = 0.5  # of those, sessions that then update it
+DELETE_SHARE = 0.5  # of those, sessions that then delete it
+DRIFT_EXAMPLES = 10  # drifted users and businesses listed in the report
+
+worker = {}  # the service of a worker process
+
+
+# The steps of one scripted session, each a menu action and its
+# arguments. Sessions pick businesses as often as reviewers do, so the
+# most reviewed businesses see the most concurrent writes.
+def session_trace(rng, dataset):
+    user = rng.choice(dataset["user"])
+    business = dataset["business"][zipf_choices(
+        rng, len(dataset["business"]), 1)[0]]
+    location = {"city": business["city"], "state": business["state"]}
+    trace = [("Login", user["name"]),
+             ("Search by city", location),
+             ("Search by category", location,
+              rng.choice(business["categories"].split(", "))),
+             ("View reviews", business["business_id"]),
+             ("View top review", business["business_id"], rng.choice(VOTES))]
+    if rng.random() < WRITE_SHARE:
+        trace.append(("Create review", business["business_id"],
+                      rng.randint(1, 5)))
+        if rng.random() < UPDATE_SHARE:
+            trace.append(("Update review", rng.randint(1, 5)))
+        if rng.random() < DELETE_SHARE:
+            trace.append(("Delete review",))
+    trace.append(("View my reviews",))
+    return trace
+
+
+# The menu actions. Each takes the state of the session replaying it,
+# holding the service, the logged-in session and the review it wrote,
+# and raises if the action fails.
+def login(state, name):
+    user = state["service"].login(name, PASSWORD)
+    if not user:
+        raise LookupError(f"cannot log in as {name}")
+    state["session"] = Session(state["service"], user)
+
+
+def search_by_city(state, location):
+    state["service"].search_businesses(location)
+
+
+def search_by_category(state, location, category):
+    state["service"].search_businesses(location, category=category)
+
+
+def view_reviews(state, business_id):
+    page = state["service"].business_reviews(business_id)
+    if page["after"]:
+        state["service"].business_reviews(business_id, after=page["after"])
+
+
+def view_top_review(state, business_id, vote):
+    state["service"].top_review(business_id, vote)
+
+
+def create_review(state, business_id, stars):
+    review = state["session"].create_review(business_id, stars,
+                                            "Load test review.")
+    if not review:
+        raise LookupError(f"no business {business_id}")
+    state["review"] = review
+    state["users"].add(review.user_id)
+    state["businesses"].add(business_id)
+
+
+def update_review(state, stars):
+    if not state["session"].update_review(state["review"].review_id, stars,
+                                          "Updated load test review."):
+        raise LookupError(f"no review {state['review'].review_id}")
+
+
+def delete_review(state):
+    if not state["session"].delete_review(state["review"].review_id):
+        raise LookupError(f"no review {state['review'].review_id}")
+
+
+def view_my_reviews(state):
+    state["service"].user_reviews(state["session"].user_id)
+
+
+ACTIONS = {"Login": login, "Search by city": search_by_city,
+           "Search by category": search_by_category,
+           "View reviews": view_reviews, "View top review": view_top_review,
+           "Create review": create_review, "Update review": update_review,
+           "Delete review": delete_review,
+           "View my reviews": view_my_reviews}
+
+
+# Connects a worker process to the database. Each worker has its own
+# client and service, and so its own caches, like a separate application
+# server would.
+def start_worker(uri, database):
+    worker["service"] = ReviewsService(MongoClient(uri)[database])
+
+
+# Replays a session trace in a worker process. A failed action ends the
+# session, as the actions after it depend on it. Returns the latencies in
+# ms and the errors of each action, and the users and businesses whose
+# running totals the session changed.
+def replay_session(trace):
+    state = {"service": worker["service"], "session": None, "review": None,
+             "users": set(), "businesses": set()}
+    latencies, errors = {}, {}
+    for action, *arguments in trace:
+        started = time.perf_counter()
+        try:
+            ACTIONS[action](state, *arguments)
+        except Exception as error:
+            message = f"{type(error).__name__}: {error}"
+            action_errors = errors.setdefault(action, {})
+            action_errors[message] = action_errors.get(message, 0) + 1
+            break
+        latencies.setdefault(action, []).append(
+            (time.perf_counter() - started) * 1000)
+    return {"latencies": latencies, "errors": errors,
+            "users": state["users"], "businesses": state["businesses"]}
+
+
+# The users or businesses among ids whose review_count or stars_total no
+# longer match the reviews written for them
+def review_stats_drift(db, collection, key, ids):
+    reviews = {stats["_id"]: stats for stats in db.review.aggregate([
+        {"$match": {key: {"$in": ids}}},
+        {"$group": {"_id": f"${key}", "count": {"$sum": 1},
+                    "stars": {"$sum": "$stars"}}}])}
+    average_field = "stars" if collection == "business" else "average_stars"
+    drifted = {}
+    for document in db[collection].find(
+            {key: {"$in": ids}}, {"_id": 0, key: 1, "review_count": 1,
+                                  "stars_total": 1, average_field: 1}):
+        actual = reviews.get(document[key], {"count": 0, "stars": 0})
+        count = document.get("review_count", 0)
+        # Documents not written since stars_total existed hold an average
+        stars = document.get("stars_total",
+                             (document.get(average_field) or 0) * count)
+        if count != actual["count"] or abs(stars - actual["stars"]) > 1e-6:
+            drifted[document[key]] = {
+                "review_count": count, "reviews": actual["count"],
+                "stars_total": stars, "review_stars": actual["stars"]}
+    return drifted
+
+
+# Generates a dataset into a scratch database, replays the given number of
+# scripted sessions against it from a pool of worker processes and
+# returns the report
+def run_load_test(uri, database, sessions=500, workers=None,
+                  businesses=1000, users=5000, reviews=20000, seed=0):
+    client = MongoClient(uri)
+    db = client[database]
+    print(f"Generating {businesses} businesses, {users} users and "
+          f"{reviews} reviews...")
+    client.drop_database(database)
+    dataset = generate_dataset(businesses, users, reviews, seed)
+    insert_dataset(db, dataset)
+    rng = random.Random(seed)
+    traces = [session_trace(rng, dataset) for _ in range(sessions)]
+
+    workers = workers or os.cpu_count()
+    print(f"Replaying {sessions} sessions from {workers} processes...")
+    latencies, errors = {}, {}
+    touched = {"user": set(), "business": set()}
+    # Workers are spawned rather than forked, so none inherits the
+    # connections of this process's client
+    context = multiprocessing.get_context("spawn")
+    started = time.perf_counter()
+    with context.Pool(workers, initializer=start_worker,
+                      initargs=(uri, database)) as pool:
+        for result in pool.imap_unordered(replay_session, traces,
+                                          chunksize=4):
+            for action, times in result["latencies"].items():
+                latencies.setdefault(action, []).extend(times)
+            for action, messages in result["errors"].items():
+                action_errors = errors.setdefault(action, {})
+                for message, count in messages.items():
+                    action_errors[message] = \
+                        action_errors.get(message, 0) + count
+            touched["user"] |= result["users"]
+            touched["business"] |= result["businesses"]
+    elapsed = time.perf_counter() - started
+
+    actions = {}
+    for action in ACTIONS:
+        times = latencies.get(action, [])
+        failed = sum(errors.get(action, {}).values())
+        if not times and not failed:
+            continue
+        actions[action] = {
+            "calls": len(times) + failed, "errors": failed,
+            "error_rate": round(failed / (len(times) + failed), 4),
+            **{f"p{percent}_ms": percentile(times, percent)
+               for percent in (50, 95, 99)}}
+        if failed:
+            actions[action]["error_messages"] = errors[action]
+    calls = sum(action["calls"] for action in actions.values())
+
+    drift = {collection: review_stats_drift(db, collection,
+                                            f"{collection}_id", sorted(ids))
+             for collection, ids in touched.items()}
+    client.close()
+    return {"generated_at": datetime.now().isoformat(timespec="seconds"),
+            "server": server_version(db),
+            "dataset": {"businesses": businesses, "users": users,
+                        "reviews": reviews, "seed": seed},
+            "sessions": sessions, "workers": workers,
+            "elapsed_s": round(elapsed, 3),
+            "sessions_per_s": round(sessions / elapsed, 1),
+            "actions_per_s": round(calls / elapsed, 1),
+            "actions": actions,
+            "drift": {collection: {"checked": len(touched[collection]),
+                                   "drifted": len(drifted),
+                                   "examples": dict(list(drifted.items())
+                                                    [:DRIFT_EXAMPLES])}
+                      for collection, drifted in drift.items()}}
+
+
+def print_report(report):
+    print(f"\n{report['sessions']} sessions in {report['elapsed_s']} s: "
+          f"{report['sessions_per_s']} sessions/s, "
+          f"{report['actions_per_s']} actions/s\n")
+    print(f"{'Action':<20}{'Calls':>8}{'Errors':>9}{'p50 ms':>10}"
+          f"{'p95 ms':>10}{'p99 ms':>10}")
+    for action, stats in report["actions"].items():
+        print(f"{action:<20}{stats['calls']:>8}"
+              f"{stats['error_rate']:>9.2%}" +
+              "".join(f"{stats[field]:>10.2f}"
+                      if stats[field] is not None else f"{'-':>10}"
+                      for field in ("p50_ms", "p95_ms", "p99_ms")))
+    print()
+    for collection, drift in report["drift"].items():
+        print(f"{drift['drifted']} of {drift['checked']} "
+              f"{'businesses' if collection == 'business' else 'users'} "
+              f"written to have totals that no longer match their reviews.")
+        for key, stats in drift["examples"].items():
+            print(f"  {key}: review_count {stats['review_count']} for "
+                  f"{stats['reviews']} reviews, stars_total "
+                  f"{stats['stars_total']} for {stats['review_stars']}")
+
+
+# Runs the load test in the named scratch database and writes its report
+# to output if given. Returns the report.
+def load_test(uri, database, output=None, **options):
+    if database == "yelp":
+        raise SystemExit("The load test drops its database; "
+                         "choose one other than yelp.")
+    report = run_load_test(uri, database, **options)
+    print_report(report)
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {output}.")
+    return report
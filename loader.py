@@ -0,0 +1,226 @@
+# ----------------------------------------------------------------------
+# Name:        loader
+# Purpose:     Streams the business, user and review files of Yelp's
+#              public dataset into the database. Each file is read line
+#              by line, validated and normalized, and written in
+#              unordered batches by a pool of workers. Progress is
+#              checkpointed so that an interrupted load can resume where
+#              it stopped, and secondary indexes are only built once
+#              the data is in.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pymongo.errors import BulkWriteError
+import json
+import os
+import time
+
+from reviews_service import (DUPLICATE_KEY, INDEXES, business_search_fields,
+                             ensure_indexes)
+
+LOAD_ORDER = ("business", "user", "review")
+
+REQUIRED_FIELDS = {"business": ("business_id", "name"),
+                   "user": ("user_id", "name"),
+                   "review": ("review_id", "user_id", "business_id", "stars")}
+INTEGER_FIELDS = {"business": ("review_count",),
+                  "user": ("review_count", "useful", "funny", "cool",
+                           "fans"),
+                  "review": ("useful", "funny", "cool")}
+FLOAT_FIELDS = {"business": ("stars", "latitude", "longitude"),
+                "user": ("average_stars",),
+                "review": ("stars",)}
+
+
+# Loads the given files, a dict of collection name to NDJSON path, then
+# builds the secondary indexes. Returns the number of documents written
+# to each collection. The checkpoint is removed once every file is in.
+def load_dataset(db, files, batch_size=1000, workers=4,
+                 checkpoint_path="load_checkpoint.json", report_every=5):
+    checkpoint = read_checkpoint(checkpoint_path)
+    # Only the unique id indexes are built up front: they keep a resumed
+    # load from inserting a batch twice
+    for collection in LOAD_ORDER:
+        for index in INDEXES[collection]:
+            if index.document.get("unique"):
+                db[collection].create_indexes([index])
+
+    loaded = {}
+    for collection in LOAD_ORDER:
+        if files.get(collection):
+            loaded[collection] = load_file(db, collection, files[collection],
+                                           batch_size, workers, checkpoint,
+                                           checkpoint_path, report_every)
+    remove_checkpoint(checkpoint_path)
+
+    print("Building indexes...")
+    ensure_indexes(db, wait=True)
+    return loaded
+
+
+# Loads one file, resuming from the offset its collection's checkpoint
+# holds. The offset is only trusted while the file is the one it was
+# taken from, with the same path, size and modification time.
+def load_file(db, collection, path, batch_size, workers, checkpoint,
+              checkpoint_path, report_every):
+    source_file = file_identity(path)
+    saved = checkpoint.get(collection)
+    offset = 0
+    if isinstance(saved, dict) and all(saved.get(field) == value for
+                                       field, value in source_file.items()):
+        offset = saved.get("offset", 0)
+    elif saved:
+        print(f"Ignoring the {collection} checkpoint: it was taken from "
+              f"another file.")
+    if offset:
+        print(f"Resuming {collection} from byte {offset}...")
+    progress = LoadProgress(collection, report_every)
+    # Batches may finish out of order; the checkpoint only advances past
+    # a batch once every batch before it has been written too
+    ends, finished, next_to_commit = [], set(), 0
+
+    with open(path, "rb") as source, ThreadPoolExecutor(workers) as pool:
+        source.seek(offset)
+        pending = {}
+        for number, (batch, end) in enumerate(read_batches(
+                source, collection, batch_size, offset, progress)):
+            ends.append(end)
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    progress.written(future.result())
+                    finished.add(pending.pop(future))
+            pending[pool.submit(insert_batch, db[collection], batch)] = number
+
+            while next_to_commit in finished:
+                checkpoint[collection] = {**source_file,
+                                          "offset": ends[next_to_commit]}
+                next_to_commit += 1
+            write_checkpoint(checkpoint_path, checkpoint)
+            progress.report()
+
+        for future in pending:
+            progress.written(future.result())
+        checkpoint[collection] = {**source_file, "offset": source.tell()}
+        write_checkpoint(checkpoint_path, checkpoint)
+
+    progress.report(final=True)
+    return progress.rows
+
+
+# Yields lists of normalized documents together with the file offset just
+# past their last line. Lines that are not valid records are skipped.
+def read_batches(source, collection, batch_size, offset, progress):
+    batch = []
+    for line in iter(source.readline, b""):
+        offset += len(line)
+        document = parse_record(collection, line)
+        if document is None:
+            progress.rejected += 1
+            continue
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield batch, offset
+            batch = []
+    if batch:
+        yield batch, offset
+
+
+def parse_record(collection, line):
+    try:
+        document = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(document, dict):
+        return None
+    return normalize(collection, document)
+
+
+# Checks the fields the application relies on and coerces the numeric
+# ones, adding the derived fields business searches are served from.
+# Returns None for a record that cannot be used.
+def normalize(collection, document):
+    if any(document.get(field) in (None, "")
+           for field in REQUIRED_FIELDS[collection]):
+        return None
+    try:
+        for field in INTEGER_FIELDS[collection]:
+            document[field] = int(document.get(field) or 0)
+        for field in FLOAT_FIELDS[collection]:
+            if document.get(field) is not None:
+                document[field] = float(document[field])
+    except (TypeError, ValueError):
+        return None
+
+    if collection == "business":
+        document.update(business_search_fields(document))
+    elif collection == "review" and not 1 <= document["stars"] <= 5:
+        return None
+    return document
+
+
+# Writes a batch, ignoring documents already written by an earlier,
+# interrupted run. Returns the number of documents inserted.
+def insert_batch(collection, batch):
+    try:
+        return len(collection.insert_many(batch, ordered=False)
+                   .inserted_ids)
+    except BulkWriteError as error:
+        details = error.details
+        if any(write_error["code"] != DUPLICATE_KEY
+               for write_error in details["writeErrors"]):
+            raise
+        return details["nInserted"]
+
+
+# The path, size and modification time a checkpoint offset is taken from
+def file_identity(path):
+    status = os.stat(path)
+    return {"path": os.path.abspath(path), "size": status.st_size,
+            "mtime_ns": status.st_mtime_ns}
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+# Replaces the checkpoint file atomically so a crash never leaves it
+# half written
+def write_checkpoint(path, checkpoint):
+    with open(path + ".tmp", "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(path + ".tmp", path)
+
+
+def remove_checkpoint(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class LoadProgress:
+    def __init__(self, collection, report_every):
+        self.collection = collection
+        self.report_every = report_every
+        self.rows = 0
+        self.rejected = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    def written(self, rows):
+        self.rows += rows
+
+    def report(self, final=False):
+        now = time.monotonic()
+        if not final and now - self.reported < self.report_every:
+            return
+        self.reported = now
+        rate = self.rows / max(now - self.started, 1e-9)
+        print(f"{self.collection}: {self.rows} rows written, "
+              f"{self.rejected} rejected ({rate:.0f} rows/sec)")
@@ -0,0 +1,87 @@
+# ----------------------------------------------------------------------
+# Name:        records
+# Purpose:     The businesses, users and reviews the service returns.
+#              Each record type lists the fields the application shows,
+#              which is also the projection its queries fetch, and
+#              stores them in __slots__ rather than a per-record dict so
+#              that long listings stay small in memory.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+
+
+# Fields missing from the document a record is built from are None
+class Record:
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    @classmethod
+    def from_document(cls, document):
+        return cls(**document)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \
+            self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}"
+                           for field in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Business(Record):
+    fields = ("business_id", "name", "address", "city", "state",
+              "postal_code", "categories", "stars", "review_count")
+    # distance is set by searches near a location, in km
+    __slots__ = fields + ("distance",)
+
+    def as_dict(self):
+        document = super().as_dict()
+        if document["distance"] is None:
+            del document["distance"]
+        return document
+
+
+class User(Record):
+    fields = ("user_id", "name", "yelping_since", "review_count", "useful",
+              "funny", "cool", "fans", "average_stars")
+    __slots__ = fields
+
+
+# A review with the names of its author and business. truncated is set
+# when text holds only the start of the review.
+class Review(Record):
+    fields = ("review_id", "user_id", "business_id", "date", "stars",
+              "useful", "funny", "cool", "text")
+    __slots__ = fields + ("truncated", "user_name", "business_name")
+
+    # The author and business are nested under "user" and "business"
+    def as_dict(self):
+        document = {field: getattr(self, field) for field in self.fields}
+        document["truncated"] = self.truncated
+        document["user"] = {"user_id": self.user_id,
+                            "name": self.user_name}
+        document["business"] = {"business_id": self.business_id,
+                                "name": self.business_name}
+        return document
+
+
+# How many of a business's reviews gave it each of 1 to 5 stars, as a
+# list of five counts, and how many were written in each month, as a dict
+# of "YYYY-MM" to count in month order
+class BusinessStats(Record):
+    fields = ("business_id", "stars", "months")
+    __slots__ = fields
+
+
+# The JSON form of a record, for json.dumps's default
+def encode(value):
+    if isinstance(value, Record):
+        return value.as_dict()
+    return str(value)
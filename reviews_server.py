@@ -0,0 +1,392 @@
+# ----------------------------------------------------------------------
+# Name:        reviews_server
+# Purpose:     Serves the queries of the Business Reviews System as a
+#              JSON API over HTTP. Connections are handled by an asyncio
+#              event loop, so idle keep-alive clients cost nothing, while
+#              the blocking database calls run on a bounded pool of
+#              threads sharing the service's pooled MongoClient.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs, unquote
+import asyncio
+import functools
+import hmac
+import json
+import os
+import re
+
+import instrumentation
+from records import encode
+from reviews_service import SIMILAR_LIMIT
+
+MAX_BODY_SIZE = 64 * 1024  # bytes accepted in a request body
+MAX_BULK_BODY_SIZE = 16 * 1024 * 1024  # bytes accepted by bulk routes
+MAX_HEADER_COUNT = 100  # headers accepted in a request
+KEEP_ALIVE_TIMEOUT = 30  # seconds an idle connection is kept open
+# Key partner feeds send as their bearer token to ingest reviews in bulk;
+# bulk ingestion is refused while it is unset
+INGEST_KEY = os.environ.get("REVIEWS_INGEST_KEY")
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+
+# Route handlers take the service, the path's captured groups, the query
+# string parameters and the JSON body, and return the response document
+# or None for a resource that does not exist. Handlers of routes that act
+# as a user take the id of the user whose session token the request
+# carries before the captured groups.
+def login(service, params, body):
+    user = service.login(required_string(body, "name"),
+                         required_string(body, "password"))
+    if not user:
+        raise HTTPError(401, "incorrect username or password")
+    return {"user": user, "token": service.start_session(user.user_id)}
+
+
+def register(service, params, body):
+    user = service.register(required_string(body, "name"),
+                            required_string(body, "password"))
+    if not user:
+        raise HTTPError(500, "the account could not be created")
+    return user
+
+
+def search_businesses(service, params, body):
+    location = search_location(params)
+    attributes = {field: params[field]
+                  for field in ("name", "category", "sort")
+                  if field in params}
+    for field in ("rating", "min_stars", "max_stars", "min_reviews"):
+        if field in params:
+            attributes[field] = number(params[field], field)
+    if "min_reviews" in attributes:
+        attributes["min_reviews"] = int(attributes["min_reviews"])
+    return service.search_businesses(location, **attributes,
+                                     **page_bounds(params))
+
+
+def suggest_business_names(service, params, body):
+    return {"names": service.suggest_business_names(
+        required(params, "prefix"), search_location(params))}
+
+
+def search_users(service, params, body):
+    return service.search_users(required(params, "name"),
+                                **page_bounds(params))
+
+
+def get_business(service, business_id, params, body):
+    return service.get_business(business_id)
+
+
+def business_reviews(service, business_id, params, body):
+    return service.business_reviews(business_id, **page_bounds(params))
+
+
+def top_review(service, business_id, vote, params, body):
+    return service.top_review(business_id, vote)
+
+
+def similar_businesses(service, business_id, params, body):
+    limit = int(number(params.get("limit", SIMILAR_LIMIT), "limit"))
+    businesses = service.similar_businesses(business_id, limit)
+    return None if businesses is None else {"businesses": businesses}
+
+
+def business_stats(service, business_id, params, body):
+    return service.business_stats(business_id)
+
+
+def user_profile(service, user_id, params, body):
+    return service.user_profile(user_id)
+
+
+def user_reviews(service, user_id, params, body):
+    return service.user_reviews(user_id, **page_bounds(params))
+
+
+def leaderboard(service, name, params, body):
+    return {"entries": service.leaderboard(name)}
+
+
+def create_review(service, user_id, params, body):
+    return service.create_review(user_id,
+                                 required_string(body, "business_id"),
+                                 required(body, "stars"),
+                                 required_string(body, "text"))
+
+
+def ingest_reviews(service, params, body):
+    reviews = required(body, "reviews")
+    if not isinstance(reviews, list):
+        raise HTTPError(400, "reviews must be a list")
+    return service.ingest_reviews(reviews)
+
+
+def update_review(service, user_id, review_id, params, body):
+    return service.update_review(user_id, review_id,
+                                 required(body, "stars"),
+                                 required_string(body, "text"))
+
+
+def delete_review(service, user_id, review_id, params, body):
+    if not service.delete_review(user_id, review_id):
+        return None
+    return {"deleted": review_id}
+
+
+def vote(service, user_id, review_id, params, body):
+    voted = service.vote(user_id, review_id, required_string(body, "vote"))
+    if voted is False:
+        raise HTTPError(409, "this vote has already been cast")
+    return {"review_id": review_id, "vote": body["vote"]} if voted else None
+
+
+# The cache counters, and the query statistics when the server runs
+# instrumented
+def query_stats(service, params, body):
+    monitor = instrumentation.current_monitor()
+    return {"caches": service.cache_stats(),
+            "queries": monitor.summary() if monitor else None}
+
+
+# Each route is a method, a path pattern, a handler and who may call it:
+# anyone (None), a logged-in "user" or an "ingest" partner feed
+ROUTES = [
+    ("POST", r"/login", login, None),
+    ("POST", r"/users", register, None),
+    ("GET", r"/businesses", search_businesses, None),
+    ("GET", r"/businesses/suggestions", suggest_business_names, None),
+    ("GET", r"/businesses/([^/]+)", get_business, None),
+    ("GET", r"/businesses/([^/]+)/reviews", business_reviews, None),
+    ("GET", r"/businesses/([^/]+)/top-reviews/([^/]+)", top_review, None),
+    ("GET", r"/businesses/([^/]+)/similar", similar_businesses, None),
+    ("GET", r"/businesses/([^/]+)/stats", business_stats, None),
+    ("GET", r"/users", search_users, None),
+    ("GET", r"/users/([^/]+)", user_profile, None),
+    ("GET", r"/users/([^/]+)/reviews", user_reviews, None),
+    ("GET", r"/leaderboards/([^/]+)", leaderboard, None),
+    ("POST", r"/reviews", create_review, "user"),
+    ("POST", r"/reviews/bulk", ingest_reviews, "ingest"),
+    ("PUT", r"/reviews/([^/]+)", update_review, "user"),
+    ("DELETE", r"/reviews/([^/]+)", delete_review, "user"),
+    ("POST", r"/reviews/([^/]+)/votes", vote, "user"),
+    ("GET", r"/stats", query_stats, None),
+]
+ROUTES = [(method, re.compile(pattern + "$"), handler, auth)
+          for method, pattern, handler, auth in ROUTES]
+
+
+def required(fields, name):
+    if fields.get(name) in (None, ""):
+        raise HTTPError(400, f"missing parameter: {name}")
+    return fields[name]
+
+
+# A required field that must be a string. JSON bodies can hold objects,
+# which would otherwise reach the database as query operators.
+def required_string(fields, name):
+    value = required(fields, name)
+    if not isinstance(value, str):
+        raise HTTPError(400, f"{name} must be a string")
+    return value
+
+
+def number(value, name):
+    try:
+        return float(value)
+    except ValueError:
+        raise HTTPError(400, f"{name} must be a number")
+
+
+# A search's location: a city and state, a zipcode, or a latitude and
+# longitude with an optional radius_km
+def search_location(params):
+    if "latitude" in params or "longitude" in params:
+        location = {field: number(required(params, field), field)
+                    for field in ("latitude", "longitude")}
+        if "radius_km" in params:
+            location["radius_km"] = number(params["radius_km"], "radius_km")
+        return location
+    return {field: params[field]
+            for field in ("city", "state", "zipcode") if field in params}
+
+
+def page_bounds(params):
+    if "after" in params and "before" in params:
+        raise HTTPError(400, "give either after or before, not both")
+    return {bound: params[bound] for bound in ("after", "before")
+            if bound in params}
+
+
+# The largest request body accepted for a request; bulk ingestion takes
+# thousands of reviews at once
+def body_limit(method, target):
+    if method == "POST" and urlsplit(target).path.rstrip("/") == \
+            "/reviews/bulk":
+        return MAX_BULK_BODY_SIZE
+    return MAX_BODY_SIZE
+
+
+# Finds the handler of a request, who may call it and the arguments
+# captured from its path. A path that exists under another method is a
+# 405, not a 404.
+def route(method, path):
+    allowed = False
+    for route_method, pattern, handler, auth in ROUTES:
+        match = pattern.match(path)
+        if match:
+            if route_method == method:
+                return handler, auth, [unquote(group)
+                                       for group in match.groups()]
+            allowed = True
+    raise HTTPError(405 if allowed else 404)
+
+
+# The token of an "Authorization: Bearer" header, or None
+def bearer_token(headers):
+    scheme, _, token = (headers or {}).get("authorization",
+                                           "").partition(" ")
+    return token.strip() or None if scheme.lower() == "bearer" else None
+
+
+# Checks that a request may call its route, then calls its handler.
+# Routes that act as a user get the id of the user the token was issued
+# to, so no request can write as anyone else.
+def call_handler(service, handler, auth, token, arguments, params, body):
+    if auth == "user":
+        user_id = service.session_user(token) if token else None
+        if not user_id:
+            raise HTTPError(401, "log in and send the session token")
+        arguments = [user_id, *arguments]
+    elif auth == "ingest":
+        if not (INGEST_KEY and token and
+                hmac.compare_digest(token.encode(), INGEST_KEY.encode())):
+            raise HTTPError(403, "bulk ingestion needs the ingest key")
+    return handler(service, *arguments, params, body)
+
+
+# Runs a request's handler on the thread pool and returns the status and
+# JSON document of its response
+async def dispatch(service, pool, method, target, body, headers=None):
+    try:
+        url = urlsplit(target)
+        handler, auth, arguments = route(method,
+                                         url.path.rstrip("/") or "/")
+        params = {name: values[-1]
+                  for name, values in parse_qs(url.query).items()}
+        try:
+            body = json.loads(body) if body else {}
+        except ValueError:
+            raise HTTPError(400, "the request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise HTTPError(400, "the request body must be a JSON object")
+
+        result = await asyncio.get_running_loop().run_in_executor(
+            pool, functools.partial(call_handler, service, handler, auth,
+                                    bearer_token(headers), arguments,
+                                    params, body))
+        if result is None:
+            raise HTTPError(404)
+        return (201 if method == "POST" and handler is not login
+                else 200), result
+    except HTTPError as error:
+        return error.status, {"error": str(error)}
+    except ValueError as error:
+        return 400, {"error": str(error)}
+    except Exception as error:
+        print(f"{method} {target} failed: {error!r}")
+        return 500, {"error": "internal server error"}
+
+
+# Reads the request line and headers of the next request on a connection.
+# Returns None once the client has closed it.
+async def read_request_head(reader):
+    line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_HEADER_COUNT:
+            raise HTTPError(431)
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return method.upper(), target, version, headers
+
+
+async def handle_connection(service, pool, reader, writer):
+    try:
+        while True:
+            keep_alive = False
+            try:
+                head = await read_request_head(reader)
+                if head is None:
+                    break
+                method, target, version, headers = head
+                connection = headers.get("connection", "").lower()
+                keep_alive = (connection == "keep-alive" if version ==
+                              "HTTP/1.0" else connection != "close")
+                length = int(headers.get("content-length") or 0)
+                if length > body_limit(method, target):
+                    keep_alive = False
+                    raise HTTPError(413)
+                body = await reader.readexactly(length) if length else b""
+                status, document = await dispatch(service, pool, method,
+                                                  target, body, headers)
+            except HTTPError as error:
+                status, document = error.status, {"error": str(error)}
+                keep_alive = keep_alive and status != 400
+            except ValueError:
+                status, document = 400, {"error": "invalid content-length"}
+                keep_alive = False
+
+            write_response(writer, status, document, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+            ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def write_response(writer, status, document, keep_alive):
+    payload = json.dumps(document, default=encode).encode()
+    writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                 f"Content-Type: application/json\r\n"
+                 f"Content-Length: {len(payload)}\r\n"
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"
+                 f"\r\n\r\n".encode("latin-1") + payload)
+
+
+async def run_server(service, host, port, workers):
+    with ThreadPoolExecutor(workers) as pool:
+        server = await asyncio.start_server(
+            functools.partial(handle_connection, service, pool), host, port)
+        print(f"Serving the Business Reviews API on http://{host}:{port}/ "
+              f"with {workers} workers")
+        async with server:
+            await server.serve_forever()
+
+
+def serve(service, host="0.0.0.0", port=8080, workers=32):
+    try:
+        asyncio.run(run_server(service, host, port, workers))
+    except KeyboardInterrupt:
+        print("Server stopped.")
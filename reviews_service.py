@@ -0,0 +1,1609 @@
+# ----------------------------------------------------------------------
+# Name:        reviews_service
+# Purpose:     The queries of the Business Reviews System, free of any
+#              user interface. ReviewsService runs the numbered queries
+#              and returns plain data, which the command line menus and
+#              the HTTP server present. The functions below it maintain
+#              the indexes and the precomputed statistics the queries
+#              read from.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, IndexModel, UpdateOne
+from pymongo import InsertOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId
+from bson.errors import InvalidId
+from datetime import date, datetime, timedelta, timezone
+import base64
+import hashlib
+import json
+import os
+import string
+import re
+import secrets
+import threading
+
+from entity_cache import CACHE_MAX_BYTES, CACHE_TTL, EntityCache
+from instrumentation import query
+from records import Business, BusinessStats, Review, User
+from vote_buffer import VoteBuffer
+
+REVIEW_BATCH_SIZE = 100  # reviews whose references are resolved together
+PAGE_SIZE = 10  # results shown per page of a listing
+SEARCH_COUNT_CAP = 100  # searches report "100+" rather than count further
+SUGGESTION_LIMIT = 10  # business names suggested for a prefix
+SIMILAR_LIMIT = 5  # similar businesses recommended
+REVIEW_PREVIEW_LENGTH = 300  # characters of review text shown in listings
+STATS_CACHE_TTL = 600  # seconds before a business's stats are recomputed
+INGEST_BATCH_SIZE = 1000  # reviews written per bulk write when ingesting
+ID_LENGTH = 22  # characters of a generated id, about 131 random bits
+ID_ALPHABET = string.digits + string.ascii_letters
+ID_ATTEMPTS = 5  # ids drawn for a document before its insert fails
+DUPLICATE_KEY = 11000  # server error code of a unique index violation
+SESSION_TTL = 24 * 60 * 60  # seconds an API session token stays valid
+METERS_PER_KM = 1000
+VOTES = ("useful", "funny", "cool")  # kinds of vote a review can receive
+# Orders business searches can be listed in: field and whether descending
+BUSINESS_SORTS = {"name": ("name", False), "stars": ("stars", True),
+                  "review_count": ("review_count", True)}
+TOP_REVIEW_QUERIES = dict(zip(VOTES, ("Query 13", "Query 14", "Query 15")))
+
+# Fields of the records the service returns; queries fetch nothing else
+BUSINESS_FIELDS = dict.fromkeys(Business.fields, 1)
+USER_FIELDS = dict.fromkeys(User.fields, 1)
+REVIEW_FIELDS = dict.fromkeys(Review.fields, 1)
+REVIEW_LISTING_FIELDS = {**REVIEW_FIELDS,
+                         "text": {"$substrCP": ["$text", 0,
+                                                REVIEW_PREVIEW_LENGTH]},
+                         "text_length": {"$strLenCP": "$text"}}
+
+# Leaderboards of the View menu, precomputed into the leaderboards
+# collection. qualifies mirrors filter for documents updated in place.
+LEADERBOARD_SIZE = 25  # entries stored, so some may drop out before refresh
+LEADERBOARDS = {
+    "top_rated_businesses": {
+        "query": "Query 8",
+        "collection": "business", "key": "business_id", "shown": 10,
+        "filter": {"stars": 5, "review_count": {"$gte": 100}},
+        "qualifies": lambda business: (business.get("stars") == 5 and
+                                       business.get("review_count", 0) >= 100),
+        "sort": [("stars", DESCENDING), ("review_count", DESCENDING)],
+        "fields": BUSINESS_FIELDS},
+    "most_reviewed_businesses": {
+        "query": "Query 9",
+        "collection": "business", "key": "business_id", "shown": 1,
+        "filter": {}, "qualifies": lambda business: True,
+        "sort": [("review_count", DESCENDING)],
+        "fields": BUSINESS_FIELDS},
+    "most_reviews_users": {
+        "query": "Query 16",
+        "collection": "user", "key": "user_id", "shown": 1,
+        "filter": {}, "qualifies": lambda user: True,
+        "sort": [("review_count", DESCENDING)],
+        "fields": USER_FIELDS},
+    "harshest_critics": {
+        "query": "Query 17",
+        "collection": "user", "key": "user_id", "shown": 1,
+        "filter": {"review_count": {"$gt": 100},
+                   "average_stars": {"$exists": True}},
+        "qualifies": lambda user: (user.get("review_count", 0) > 100 and
+                                   "average_stars" in user),
+        "sort": [("average_stars", ASCENDING)],
+        "fields": USER_FIELDS},
+}
+
+# Every index the numbered queries rely on. ensure_indexes builds whatever
+# is missing at startup and check-plans verifies that the queries use them.
+INDEXES = {
+    "business": [
+        IndexModel([("business_id", ASCENDING)], unique=True),
+        # Queries 2 - 6 and filtered searches by location, in name,
+        # rating or review count order. The rating fields trail each sort
+        # so that range filters on them are applied to index keys.
+        IndexModel([("state", ASCENDING), ("city", ASCENDING),
+                    ("name", ASCENDING), ("_id", ASCENDING),
+                    ("stars", ASCENDING), ("review_count", ASCENDING)]),
+        IndexModel([("postal_code", ASCENDING), ("name", ASCENDING),
+                    ("_id", ASCENDING), ("stars", ASCENDING),
+                    ("review_count", ASCENDING)]),
+        IndexModel([("state", ASCENDING), ("city", ASCENDING),
+                    ("stars", ASCENDING), ("_id", ASCENDING),
+                    ("review_count", ASCENDING)]),
+        IndexModel([("postal_code", ASCENDING), ("stars", ASCENDING),
+                    ("_id", ASCENDING), ("review_count", ASCENDING)]),
+        IndexModel([("state", ASCENDING), ("city", ASCENDING),
+                    ("review_count", ASCENDING), ("_id", ASCENDING),
+                    ("stars", ASCENDING)]),
+        IndexModel([("postal_code", ASCENDING), ("review_count", ASCENDING),
+                    ("_id", ASCENDING), ("stars", ASCENDING)]),
+        IndexModel([("state", ASCENDING), ("city", ASCENDING),
+                    ("name_words", ASCENDING)]),
+        IndexModel([("postal_code", ASCENDING), ("name_words", ASCENDING)]),
+        IndexModel([("state", ASCENDING), ("city", ASCENDING),
+                    ("name_key", ASCENDING)]),
+        IndexModel([("postal_code", ASCENDING), ("name_key", ASCENDING)]),
+        IndexModel([("state", ASCENDING), ("city", ASCENDING),
+                    ("category_tokens", ASCENDING)]),
+        IndexModel([("postal_code", ASCENDING),
+                    ("category_tokens", ASCENDING)]),
+        # Searches near a location
+        IndexModel([("location", GEOSPHERE)]),
+        # Query 8
+        IndexModel([("stars", DESCENDING), ("review_count", DESCENDING)]),
+        # Query 9
+        IndexModel([("review_count", DESCENDING)]),
+    ],
+    "user": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        # Login and query 7
+        IndexModel([("name", ASCENDING), ("_id", ASCENDING)]),
+        # Query 16
+        IndexModel([("review_count", DESCENDING)]),
+        # Query 17
+        IndexModel([("average_stars", ASCENDING),
+                    ("review_count", ASCENDING)]),
+    ],
+    "review": [
+        IndexModel([("review_id", ASCENDING)], unique=True),
+        # Query 10
+        IndexModel([("user_id", ASCENDING), ("date", DESCENDING),
+                    ("_id", DESCENDING)]),
+        # Query 12, and business stats, which read only these keys
+        IndexModel([("business_id", ASCENDING), ("date", DESCENDING),
+                    ("_id", DESCENDING), ("stars", ASCENDING)]),
+        # Queries 13 - 15
+        IndexModel([("business_id", ASCENDING), ("useful", DESCENDING)]),
+        IndexModel([("business_id", ASCENDING), ("funny", DESCENDING)]),
+        IndexModel([("business_id", ASCENDING), ("cool", DESCENDING)]),
+    ],
+    "review_votes": [
+        # One vote of each kind per user per review
+        IndexModel([("review_id", ASCENDING), ("user_id", ASCENDING),
+                    ("vote", ASCENDING)], unique=True),
+    ],
+    "sessions": [
+        # The server removes sessions once they expire
+        IndexModel([("expires", ASCENDING)], expireAfterSeconds=0),
+    ],
+}
+
+
+# The numbered query a business search runs: one of Queries 4 - 6 when it
+# filters on an attribute, otherwise Query 2 or 3 by its location.
+# Searches combining filters, or filtering on ranges, are advanced ones.
+def search_query(service, location, name=None, category=None, rating=None,
+                 min_stars=None, max_stars=None, min_reviews=None,
+                 sort=None, **bounds):
+    attributes = [(number, attribute) for number, attribute in
+                  ((4, name), (5, category), (6, rating))
+                  if attribute is not None]
+    if len(attributes) > 1 or sort is not None or any(
+            bound is not None for bound in (min_stars, max_stars,
+                                            min_reviews)):
+        return "Advanced search"
+    if attributes:
+        return f"Query {attributes[0][0]}"
+    if "latitude" in location:
+        return "Nearby search"
+    return "Query 3" if location.get("zipcode") else "Query 2"
+
+
+# The operations of the Business Reviews System. Methods return records
+# (the Business, User and Review types of the records module), plain
+# values, or None when the thing asked for does not exist. Invalid
+# arguments raise ValueError.
+# Listings return a page: a dict of "results", "has_more" (whether more
+# results lie in the direction of travel) and "before"/"after" tokens to
+# pass back for the previous and next pages. The first page of a search
+# also carries a "count" of its matches, capped at SEARCH_COUNT_CAP + 1.
+# A service holds no per-user state, so one instance can serve any number
+# of concurrent sessions. Businesses and users are read through caches
+# that the service's own writes keep current; changes made elsewhere show
+# once the cached copy expires. The review writes given a session (see
+# the session module) also update its user's profile with their new
+# stats. Similar businesses are recommended from the vectors of the
+# similarity module, once they have been built.
+class ReviewsService:
+
+    def __init__(self, db, cache_ttl=CACHE_TTL,
+                 cache_max_bytes=CACHE_MAX_BYTES, similar=None):
+        self.db = db
+        self.similar = similar
+        self.businesses = EntityCache(cache_max_bytes, cache_ttl)
+        self.users = EntityCache(cache_max_bytes, cache_ttl)
+        self.stats = EntityCache(cache_max_bytes, STATS_CACHE_TTL)
+        self.votes = VoteBuffer(self._write_votes)
+
+    # Writes any buffered votes; call before the process exits
+    def close(self):
+        self.votes.close()
+
+    @query("Login")
+    def login(self, name, password):
+        check_credentials(name, password)
+        user = self.db.user.find_one({"name": name, "password": password},
+                                     {**USER_FIELDS, "_id": 0})
+        if not user:
+            return None
+        self.users.put(user["user_id"], user)
+        return User.from_document(user)
+
+    # Starts an API session for a user and returns its token. Only a hash
+    # of the token is stored, so the sessions collection cannot be used to
+    # act as its users.
+    @query("Session start")
+    def start_session(self, user_id):
+        token = secrets.token_urlsafe(32)
+        self.db.sessions.insert_one({
+            "_id": token_digest(token), "user_id": user_id,
+            "expires": datetime.now(timezone.utc) +
+            timedelta(seconds=SESSION_TTL)})
+        return token
+
+    # The id of the user a session token was issued to, or None if the
+    # token is unknown or has expired
+    @query("Session lookup")
+    def session_user(self, token):
+        session = self.db.sessions.find_one(
+            {"_id": token_digest(token),
+             "expires": {"$gt": datetime.now(timezone.utc)}},
+            {"_id": 0, "user_id": 1})
+        return session["user_id"] if session else None
+
+    # Query 1: Create an account
+    @query("Query 1")
+    def register(self, name, password):
+        check_credentials(name, password)
+        user = {"user_id": generate_id(), "name": name,
+                "password": password,
+                "yelping_since": str(date.today()),
+                "review_count": 0, "useful": 0, "funny": 0, "cool": 0,
+                "fans": 0, "average_stars": 0}
+        registered = insert_with_new_id(self.db.user, user, "user_id")
+        if not registered.inserted_id:
+            return None
+        user = {field: user[field] for field in USER_FIELDS}
+        self.users.put(user["user_id"], user)
+        return User.from_document(user)
+
+    # Queries 2 - 6: Search for businesses by city & state or by zipcode,
+    # then by any mix of name, category, rating, a range of stars and a
+    # minimum review count, listed in one of BUSINESS_SORTS orders. A
+    # location of latitude, longitude and an optional radius_km searches
+    # near that point instead, nearest first.
+    @query(search_query)
+    def search_businesses(self, location, name=None, category=None,
+                          rating=None, min_stars=None, max_stars=None,
+                          min_reviews=None, sort=None, after=None,
+                          before=None):
+        if "latitude" in location:
+            if sort is not None:
+                raise ValueError("searches near a location are sorted by "
+                                 "distance")
+            query = business_filter(name, category, rating, min_stars,
+                                    max_stars, min_reviews)
+            return self._nearby_page(location, query, after, before)
+        if (sort or "name") not in BUSINESS_SORTS:
+            raise ValueError(f"sort must be one of "
+                             f"{', '.join(BUSINESS_SORTS)}")
+        sort_field, descending = BUSINESS_SORTS[sort or "name"]
+        query = search_filter(location, name=name, category=category,
+                              rating=rating, min_stars=min_stars,
+                              max_stars=max_stars, min_reviews=min_reviews)
+        return self._page(self.db.business, query, sort_field, Business,
+                          descending=descending, after=after,
+                          before=before, count=True)
+
+    @query("Name suggestions")
+    def suggest_business_names(self, prefix, location,
+                               limit=SUGGESTION_LIMIT):
+        return suggest_business_names(self.db, prefix, limit, **location)
+
+    # Query 7: Search for users
+    @query("Query 7")
+    def search_users(self, name, after=None, before=None):
+        return self._page(self.db.user, {"name": name}, "name", User,
+                          after=after, before=before, count=True)
+
+    @query("Business lookup")
+    def get_business(self, business_id):
+        business = self._cached(self.businesses, self.db.business,
+                                "business_id", BUSINESS_FIELDS,
+                                [business_id]).get(business_id)
+        return Business.from_document(business) if business else None
+
+    # Businesses in the same city with categories, stars and a location
+    # most like the business's. Returns None if the business has no
+    # vectors, so also when none have been built.
+    @query("Similar businesses")
+    def similar_businesses(self, business_id, limit=SIMILAR_LIMIT):
+        if self.similar is None:
+            return None
+        business_ids = self.similar.similar(business_id, limit)
+        if business_ids is None:
+            return None
+        businesses = self._cached(self.businesses, self.db.business,
+                                  "business_id", BUSINESS_FIELDS,
+                                  business_ids)
+        return [Business.from_document(businesses[business_id])
+                for business_id in business_ids
+                if business_id in businesses]
+
+    # The star histogram and monthly review counts of a business. They
+    # are aggregated from its reviews once, then cached and patched by
+    # the service's review writes, so their reviews show at once and
+    # those written elsewhere once the stats expire.
+    @query("Business stats")
+    def business_stats(self, business_id):
+        stats = self.stats.get(business_id)
+        if stats is None:
+            if not self.get_business(business_id):
+                return None
+            stats = business_review_stats(self.db, business_id)
+            self.stats.put(business_id, stats)
+        return BusinessStats.from_document(stats)
+
+    # Query 12: View a business's reviews
+    @query("Query 12")
+    def business_reviews(self, business_id, after=None, before=None):
+        return self._page(self.db.review, {"business_id": business_id},
+                          "date", Review, descending=True, after=after,
+                          before=before)
+
+    # Queries 13 - 15: View the most useful, funniest or coolest review of
+    # a business
+    @query(lambda self, business_id, vote: TOP_REVIEW_QUERIES.get(
+        vote, "Queries 13 - 15"))
+    def top_review(self, business_id, vote):
+        if vote not in VOTES:
+            raise ValueError(f"vote must be one of {', '.join(VOTES)}")
+        review = top_review(self.db, business_id, vote)
+        return self._review_records([review])[0] if review else None
+
+    # Query 11: View your account profile
+    @query("Query 11")
+    def user_profile(self, user_id):
+        user = self._cached(self.users, self.db.user, "user_id",
+                            USER_FIELDS, [user_id]).get(user_id)
+        return User.from_document(user) if user else None
+
+    # Queries 8, 9, 16 & 17: View the leaderboards
+    @query(lambda self, name: LEADERBOARDS.get(
+        name, {}).get("query", "Leaderboards"))
+    def leaderboard(self, name):
+        if name not in LEADERBOARDS:
+            raise ValueError(f"leaderboard must be one of "
+                             f"{', '.join(LEADERBOARDS)}")
+        record = Business if LEADERBOARDS[name]["collection"] == "business" \
+            else User
+        return [record.from_document(entry)
+                for entry in read_leaderboard(self.db, name)]
+
+    # Query 10: View all reviews made by your account
+    @query("Query 10")
+    def user_reviews(self, user_id, after=None, before=None):
+        return self._page(self.db.review, {"user_id": user_id}, "date",
+                          Review, descending=True, after=after,
+                          before=before)
+
+    @query("Review lookup")
+    def get_review(self, user_id, review_id):
+        review = self.db.review.find_one({"review_id": review_id,
+                                          "user_id": user_id},
+                                         REVIEW_FIELDS)
+        return self._review_records([review])[0] if review else None
+
+    # Query 18: Create a review for a business
+    @query("Query 18")
+    def create_review(self, user_id, business_id, stars, text,
+                      session=None):
+        stars = check_stars(stars)
+        if not self._user_exists(user_id):
+            return None
+        if not self.get_business(business_id):
+            return None
+        review = {"review_id": generate_id(), "user_id": user_id,
+                  "business_id": business_id, "stars": stars,
+                  "useful": 0, "funny": 0, "cool": 0,
+                  "date": str(date.today()), "text": text}
+        created = insert_with_new_id(self.db.review, review, "review_id")
+        if not created.inserted_id:
+            return None
+        self._update_review_stats(user_id, business_id, stars, 1, session)
+        self._patch_business_stats(business_id, [(stars, review["date"], 1)])
+        offer_top_review(self.db, review)
+        return self._review_records([review])[0]
+
+    # Query 19: Update a review you made for a business. The review is
+    # read and written in one round trip, so the star delta applied to
+    # the running totals is exact even under concurrent updates.
+    @query("Query 19")
+    def update_review(self, user_id, review_id, stars, text,
+                      session=None):
+        stars = check_stars(stars)
+        previous = self.db.review.find_one_and_update(
+            {"review_id": review_id, "user_id": user_id},
+            {"$set": {"stars": stars, "date": str(date.today()),
+                      "text": text}}, {**REVIEW_FIELDS, "_id": 0})
+        if not previous:
+            return None
+        self._update_review_stats(user_id, previous["business_id"],
+                                  stars - float(previous["stars"]), 0,
+                                  session)
+        self._patch_business_stats(previous["business_id"],
+                                   [(previous["stars"], previous["date"], -1),
+                                    (stars, str(date.today()), 1)])
+        previous.update(stars=stars, date=str(date.today()), text=text)
+        return self._review_records([previous])[0]
+
+    # Query 20: Delete a review you made for a business
+    @query("Query 20")
+    def delete_review(self, user_id, review_id, session=None):
+        review = self.db.review.find_one_and_delete(
+            {"review_id": review_id, "user_id": user_id},
+            {"_id": 0, "review_id": 1, "business_id": 1, "stars": 1,
+             "date": 1})
+        if not review:
+            return False
+        self._update_review_stats(user_id, review["business_id"],
+                                  -float(review["stars"]), -1, session)
+        self._patch_business_stats(review["business_id"],
+                                   [(review["stars"], review["date"], -1)])
+        forget_top_review(self.db, review)
+        self.db.review_votes.delete_many({"review_id": review_id})
+        return True
+
+    # Writes many reviews at once, for partner feeds and migrations. Each
+    # review is a dict of user_id, business_id, stars and text, and may
+    # give a date and useful, funny and cool counts. Every batch of
+    # INGEST_BATCH_SIZE reviews is inserted with one unordered bulk write,
+    # retrying only the reviews whose ids were taken, and then added to
+    # the running totals of its authors and businesses with one more bulk
+    # write each. Returns the number of reviews written, the ids of the
+    # reviews in the order given, None for any not written, and the index
+    # and reason of every review rejected.
+    @query("Bulk ingestion")
+    def ingest_reviews(self, reviews):
+        review_ids, rejected = [], []
+        for batch in batches(reviews, INGEST_BATCH_SIZE):
+            start = len(review_ids)
+            written, errors = self._ingest_batch(batch, start)
+            review_ids.extend(written[index]["review_id"]
+                              if index in written else None
+                              for index in range(start, start + len(batch)))
+            rejected.extend({"index": index, "error": errors[index]}
+                            for index in sorted(errors))
+        if len(review_ids) > len(rejected):
+            refresh_leaderboards(self.db)
+        return {"inserted": len(review_ids) - len(rejected),
+                "review_ids": review_ids, "rejected": rejected}
+
+    # Writes a batch of ingested reviews, numbered from start. Returns the
+    # documents written and the errors of those not, by number.
+    def _ingest_batch(self, batch, start):
+        users = existing_ids(self.db.user, "user_id", batch)
+        businesses = existing_ids(self.db.business, "business_id", batch)
+        documents, errors = {}, {}
+        for index, review in enumerate(batch, start):
+            try:
+                documents[index] = ingested_review(review, users, businesses)
+            except ValueError as error:
+                errors[index] = str(error)
+
+        pending = documents
+        for attempt in range(1, ID_ATTEMPTS + 1):
+            for document, review_id in zip(pending.values(),
+                                           generate_ids(len(pending))):
+                document["review_id"] = review_id
+            failed = insert_reviews(self.db, pending)
+            pending = {}
+            for index, error in failed.items():
+                if duplicate_of(error, "review_id") and \
+                        attempt < ID_ATTEMPTS:
+                    pending[index] = documents[index]
+                else:
+                    errors[index] = error.get("errmsg", "write failed")
+            if not pending:
+                break
+
+        written = {index: document for index, document in documents.items()
+                   if index not in errors}
+        self._add_ingested_stats(written.values())
+        return written, errors
+
+    # Adds written reviews to the running totals of their authors and
+    # businesses, the top reviews of their businesses and the cached
+    # business stats
+    def _add_ingested_stats(self, reviews):
+        totals = {"user": {}, "business": {}}
+        changes = {}
+        for review in reviews:
+            for collection, entities in totals.items():
+                count, stars = entities.get(review[f"{collection}_id"],
+                                            (0, 0))
+                entities[review[f"{collection}_id"]] = (
+                    count + 1, stars + review["stars"])
+            changes.setdefault(review["business_id"], []).append(
+                (review["stars"], review["date"], 1))
+        if not changes:
+            return
+
+        for collection, average_field, half_stars, cache in (
+                ("user", "average_stars", False, self.users),
+                ("business", "stars", True, self.businesses)):
+            self.db[collection].bulk_write(
+                [UpdateOne({f"{collection}_id": key},
+                           running_average_update(average_field, stars,
+                                                  count, half_stars))
+                 for key, (count, stars) in totals[collection].items()],
+                ordered=False)
+            for key in totals[collection]:
+                cache.invalidate(key)
+        self.db.business.bulk_write(
+            [UpdateOne(*top_review_offer(review)) for review in reviews],
+            ordered=False)
+        for business_id, business_changes in changes.items():
+            self._patch_business_stats(business_id, business_changes)
+
+    # Marks a review useful, funny or cool. Each user may cast each kind
+    # of vote once per review, and never on their own reviews. Returns
+    # None if the review or the voter does not exist and False if the
+    # vote was already cast. The review's and its author's counters are
+    # incremented in batches by the vote buffer, so they show the vote
+    # within VOTE_FLUSH_INTERVAL seconds.
+    @query("Vote")
+    def vote(self, user_id, review_id, vote):
+        if vote not in VOTES:
+            raise ValueError(f"vote must be one of {', '.join(VOTES)}")
+        review = self.db.review.find_one(
+            {"review_id": review_id},
+            {"_id": 0, "review_id": 1, "user_id": 1, "business_id": 1})
+        if not review:
+            return None
+        if review["user_id"] == user_id:
+            raise ValueError("you cannot vote on your own review")
+        if not self._user_exists(user_id):
+            return None
+        try:
+            self.db.review_votes.insert_one(
+                {"review_id": review_id, "user_id": user_id, "vote": vote,
+                 "date": str(date.today())})
+        except DuplicateKeyError:
+            return False
+        self.votes.add(review, vote)
+        return True
+
+    # Applies a flush of the vote buffer: one unordered $inc per review,
+    # then the pointers of the reviews' businesses to their top reviews,
+    # then one $inc per author. Entries are removed from pending as they
+    # are written, including those applied by a bulk write that failed
+    # for others, so a retried flush never counts a vote twice.
+    @query("Vote flush")
+    def _write_votes(self, pending):
+        review_ids = [key for collection, key in pending
+                      if collection == "review"]
+        if review_ids:
+            write_pending(self.db.review, "review", review_ids, pending)
+            reviews = self.db.review.find(
+                {"review_id": {"$in": review_ids}},
+                {"_id": 0, "review_id": 1, "business_id": 1,
+                 **{vote: 1 for vote in VOTES}})
+            offers = [UpdateOne(*top_review_offer(review))
+                      for review in reviews]
+            if offers:
+                self.db.business.bulk_write(offers, ordered=False)
+
+        user_ids = [key for collection, key in pending
+                    if collection == "user"]
+        if user_ids:
+            try:
+                write_pending(self.db.user, "user", user_ids, pending)
+            finally:
+                for user_id in user_ids:
+                    self.users.invalidate(user_id)
+
+    # A page of records of the given type. Reviews are listed with their
+    # text cut to a preview.
+    def _page(self, collection, query, sort_field, record,
+              descending=False, after=None, before=None, count=False):
+        projection = (REVIEW_LISTING_FIELDS if record is Review
+                      else dict.fromkeys(record.fields, 1))
+        after = decode_page_token(after, sort_field)
+        before = decode_page_token(before, sort_field)
+        page = {}
+        if count and after is None and before is None:
+            documents, has_more, page["count"] = run_search(
+                collection, query, sort_field, projection, descending)
+        else:
+            documents, has_more = fetch_page(collection, query, sort_field,
+                                             projection, descending,
+                                             after, before)
+        page["has_more"] = has_more
+        page["before"] = page["after"] = None
+        if documents:
+            page["before"] = page_token(documents[0], sort_field)
+            page["after"] = page_token(documents[-1], sort_field)
+        if record is Review:
+            page["results"] = self._review_records(documents)
+        else:
+            page["results"] = [record.from_document(document)
+                               for document in documents]
+        return page
+
+    # Reviews with their authors and businesses resolved, a batch at a
+    # time. Listings flag reviews whose text was cut to a preview.
+    def _review_records(self, reviews):
+        records = []
+        for batch in batches(reviews, REVIEW_BATCH_SIZE):
+            users = self._cached(
+                self.users, self.db.user, "user_id", USER_FIELDS,
+                {review["user_id"] for review in batch})
+            businesses = self._cached(
+                self.businesses, self.db.business, "business_id",
+                BUSINESS_FIELDS, {review["business_id"] for review in batch})
+            for review in batch:
+                text = review.get("text", "")
+                records.append(Review(
+                    **{**review, **{vote: review.get(vote) or 0
+                                    for vote in VOTES}},
+                    truncated=review.get("text_length", len(text)) >
+                    len(text),
+                    user_name=users.get(review["user_id"], {}).get(
+                        "name", "Unknown"),
+                    business_name=businesses.get(
+                        review["business_id"], {}).get("name", "Unknown")))
+        return records
+
+    # A page of the businesses matching query nearest a location. $geoNear
+    # reads them from the 2dsphere index in order of distance, which no
+    # (key, _id) boundary can resume, so the nearest SEARCH_COUNT_CAP + 1
+    # matches are addressed by offset instead and the tokens carry it.
+    def _nearby_page(self, location, query, after=None, before=None):
+        token = after if after is not None else before
+        offset = decode_offset_token(token)
+        stages = [{"$geoNear": near_stage(query=query, **location)},
+                  {"$limit": SEARCH_COUNT_CAP + 1}]
+        listing = [{"$skip": offset}, {"$limit": PAGE_SIZE + 1},
+                   {"$project": {**BUSINESS_FIELDS, "_id": 0,
+                                 "distance": 1}}]
+        page = {}
+        if token is None:
+            result = next(self.db.business.aggregate(stages + [
+                {"$facet": {"page": listing,
+                            "count": [{"$count": "total"}]}}]))
+            documents = result["page"]
+            page["count"] = (result["count"][0]["total"]
+                             if result["count"] else 0)
+        else:
+            documents = list(self.db.business.aggregate(stages + listing))
+
+        for document in documents:
+            document["distance"] = round(document["distance"], 2)
+        page["has_more"] = (offset > 0 if before is not None
+                            else len(documents) > PAGE_SIZE)
+        page["results"] = [Business.from_document(document)
+                           for document in documents[:PAGE_SIZE]]
+        page["before"] = (offset_token(max(offset - PAGE_SIZE, 0))
+                          if offset else None)
+        page["after"] = (offset_token(offset + PAGE_SIZE)
+                         if page["results"] else None)
+        return page
+
+    # Returns the documents with the given ids, by id, reading those the
+    # cache misses with one $in query and caching them
+    def _cached(self, cache, collection, key, fields, ids):
+        found, missing = cache.get_many(ids)
+        if missing:
+            for document in collection.find({key: {"$in": missing}},
+                                            {**fields, "_id": 0}):
+                cache.put(document[key], document)
+                found[document[key]] = document
+        return found
+
+    # Whether a user exists, read through the user cache
+    def _user_exists(self, user_id):
+        return bool(self._cached(self.users, self.db.user, "user_id",
+                                 USER_FIELDS, [user_id]))
+
+    # Applies a review write to the running totals and caches the author
+    # and business as they are after it
+    def _update_review_stats(self, user_id, business_id, stars_delta,
+                             count_delta, session=None):
+        user, business = update_review_stats(self.db, user_id, business_id,
+                                             stars_delta, count_delta)
+        if session and user:
+            session.update(user)
+        for cache, key, document in ((self.users, user_id, user),
+                                     (self.businesses, business_id,
+                                      business)):
+            if document:
+                cache.put(key, without_id(document))
+            else:
+                cache.invalidate(key)
+
+    # Applies (stars, date, count) changes to a business's cached stats
+    def _patch_business_stats(self, business_id, changes):
+        self.stats.update(business_id, lambda stats: patch_review_stats(
+            stats, changes))
+
+    def cache_stats(self):
+        return {"businesses": self.businesses.stats(),
+                "users": self.users.stats(),
+                "business stats": self.stats.stats()}
+
+    # Empties the caches, so that the next queries read the database
+    def clear_caches(self):
+        for cache in (self.businesses, self.users, self.stats):
+            cache.clear()
+
+
+def without_id(document):
+    document.pop("_id", None)
+    return document
+
+
+# Increments the vote counters of the given ids in collection by their
+# pending votes with one unordered bulk write, and removes the entries it
+# applied from pending. When some increments fail the others still
+# count, so only the failed ones are left to retry. A network error is
+# retried once by the driver where the server supports retryable writes;
+# any other error leaves every entry pending.
+def write_pending(collection, name, ids, pending):
+    key = f"{name}_id"
+    try:
+        collection.bulk_write(
+            [UpdateOne({key: entity_id}, {"$inc": pending[(name, entity_id)]})
+             for entity_id in ids], ordered=False)
+    except BulkWriteError as error:
+        failed = {write_error["index"]
+                  for write_error in error.details["writeErrors"]}
+        for index, entity_id in enumerate(ids):
+            if index not in failed:
+                del pending[(name, entity_id)]
+        raise
+    for entity_id in ids:
+        del pending[(name, entity_id)]
+
+
+# A review to ingest as the document to insert, with no id yet. Raises
+# ValueError if it is invalid or its user or business does not exist.
+def ingested_review(review, users, businesses):
+    if not isinstance(review, dict):
+        raise ValueError("a review must be an object")
+    for key, known in (("user_id", users), ("business_id", businesses)):
+        if review.get(key) not in known:
+            raise ValueError(f"no {key.split('_')[0]} {review.get(key)}")
+    document = {"review_id": None, "user_id": review["user_id"],
+                "business_id": review["business_id"],
+                "stars": check_stars(review.get("stars"))}
+    for vote in VOTES:
+        try:
+            document[vote] = int(review.get(vote) or 0)
+        except (TypeError, ValueError):
+            document[vote] = -1
+        if document[vote] < 0:
+            raise ValueError(f"{vote} must be a whole number of votes")
+    document["date"] = str(review.get("date") or date.today())
+    document["text"] = str(review.get("text") or "")
+    return document
+
+
+# The ids in the key field of a batch of reviews that exist in collection
+def existing_ids(collection, key, batch):
+    ids = {review.get(key) for review in batch if isinstance(review, dict)
+           and isinstance(review.get(key), str)}
+    return {document[key] for document in collection.find(
+        {key: {"$in": list(ids)}}, {"_id": 0, key: 1})}
+
+
+# Inserts reviews, given by number, with one unordered bulk write.
+# Returns the write errors of those not inserted, by number.
+def insert_reviews(db, reviews):
+    if not reviews:
+        return {}
+    numbers = list(reviews)
+    try:
+        db.review.bulk_write([InsertOne(reviews[number])
+                              for number in numbers], ordered=False)
+    except BulkWriteError as error:
+        return {numbers[write_error["index"]]: write_error
+                for write_error in error.details["writeErrors"]}
+    return {}
+
+
+# Names and passwords are matched as given, so anything but a string,
+# such as a query operator, is refused before it reaches a query
+def check_credentials(name, password):
+    if not (isinstance(name, str) and isinstance(password, str)):
+        raise ValueError("name and password must be strings")
+
+
+# The stars of a review as an int. Numbers with a fraction are rejected
+# rather than rounded down.
+def check_stars(stars):
+    try:
+        whole = int(stars)
+        exact = not isinstance(stars, bool) and whole == float(stars)
+    except (TypeError, ValueError, OverflowError):
+        exact = False
+    if not exact or not 1 <= whole <= 5:
+        raise ValueError("stars must be a whole number from 1 to 5")
+    return whole
+
+
+# Returns up to limit distinct business names starting with prefix, read
+# in name_key order from the location + name_key index
+def suggest_business_names(db, prefix, limit=SUGGESTION_LIMIT, **kwargs):
+    query = {"name_key": {"$regex": prefix_pattern(normalize_name(prefix))}}
+    if "latitude" in kwargs:
+        # Near a location, the nearest businesses are suggested first
+        businesses = db.business.aggregate([
+            {"$geoNear": near_stage(query=query, **kwargs)},
+            {"$limit": limit * 5}, {"$project": {"_id": 0, "name": 1}}])
+    else:
+        query.update(location_query(**kwargs))
+        businesses = db.business.find(query, {"_id": 0, "name": 1}).sort(
+            "name_key", ASCENDING).limit(limit * 5)
+    names = []
+    for business in businesses:
+        if business["name"] not in names:
+            names.append(business["name"])
+            if len(names) == limit:
+                break
+    return names
+
+
+# Matches businesses with a word in their name starting with each word
+# of the given name, so "pizza h" finds "Pizza Hut" and "Hut's Pizza".
+# Businesses not yet backfilled with name_words fall back to a regex over
+# their name.
+def name_query(name):
+    words = normalize_name(name).split()
+    if not words:
+        return {}
+    return {"$or": [
+        {"$and": [{"name_words": {"$regex": prefix_pattern(word)}}
+                  for word in words]},
+        {"name_words": None,
+         "name": {"$regex": re.compile(re.escape(name.strip()),
+                                       re.IGNORECASE)}}]}
+
+
+# Matches businesses with a category token starting with the given text.
+# The prefix is a range scan on the location + category_tokens index;
+# businesses not yet backfilled with tokens fall back to a regex over
+# their raw categories string.
+def category_query(category):
+    return {"$or": [
+        {"category_tokens": {"$regex": prefix_pattern(
+            category.strip().lower())}},
+        {"category_tokens": None,
+         "categories": {"$regex": re.compile(re.escape(category.strip()),
+                                             re.IGNORECASE)}}]}
+
+
+# An anchored, case-sensitive regex whose literal prefix MongoDB can turn
+# into index bounds. \Q...\E quotes the user's input.
+def prefix_pattern(prefix):
+    if "\\E" in prefix:
+        return "^" + re.escape(prefix)
+    return "^\\Q" + prefix + "\\E"
+
+
+# The query matching every filter given, in a single document so that
+# the location and rating fields are all served by one compound index
+def business_filter(name=None, category=None, rating=None, min_stars=None,
+                    max_stars=None, min_reviews=None):
+    conditions = []
+    if name is not None:
+        conditions.append(name_query(name))
+    if category is not None:
+        conditions.append(category_query(category))
+    query = {"$and": conditions} if conditions else {}
+
+    stars = {}
+    if rating is not None:
+        stars["$eq"] = float(rating)
+    if min_stars is not None:
+        stars["$gte"] = float(min_stars)
+    if max_stars is not None:
+        stars["$lte"] = float(max_stars)
+    if stars:
+        query["stars"] = stars
+    if min_reviews is not None:
+        if int(min_reviews) < 0:
+            raise ValueError("min_reviews cannot be negative")
+        query["review_count"] = {"$gte": int(min_reviews)}
+    return query
+
+
+# The query of a business search within a city & state or a zipcode
+def search_filter(location, **filters):
+    query = business_filter(**filters)
+    query.update(location_query(**location))
+    return query
+
+
+def location_query(**kwargs):
+    if "city" in kwargs.keys() and "state" in kwargs.keys():
+        return {"state": kwargs.get("state"), "city": kwargs.get("city")}
+    if "zipcode" in kwargs.keys():
+        return {"postal_code": kwargs.get("zipcode")}
+    raise ValueError("search by city and state, or by zipcode")
+
+
+# The $geoNear stage finding businesses matching query nearest the given
+# point, with their distance from it in kilometers
+def near_stage(latitude, longitude, radius_km=None, query=None):
+    stage = {"near": geo_point(latitude, longitude), "key": "location",
+             "distanceField": "distance", "spherical": True,
+             "distanceMultiplier": 1 / METERS_PER_KM, "query": query or {}}
+    if radius_km is not None:
+        if float(radius_km) <= 0:
+            raise ValueError("radius must be a positive number of km")
+        stage["maxDistance"] = float(radius_km) * METERS_PER_KM
+    return stage
+
+
+# A GeoJSON point, which lists longitude before latitude
+def geo_point(latitude, longitude):
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError("latitude and longitude must be numbers")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("latitude must be within +-90 and longitude "
+                         "within +-180")
+    return {"type": "Point", "coordinates": [longitude, latitude]}
+
+
+# Returns the review of a business with the most votes of a kind, found
+# through the pointer kept in the business's top_reviews field
+def top_review(db, business_id, vote):
+    business = db.business.find_one({"business_id": business_id},
+                                    {f"top_reviews.{vote}": 1})
+    pointer = ((business or {}).get("top_reviews") or {}).get(vote)
+    if pointer:
+        review = db.review.find_one({"review_id": pointer["review_id"]},
+                                    {**REVIEW_FIELDS, "_id": 0})
+        if review:
+            return review
+    return refresh_top_review(db, business_id, vote)
+
+
+# Finds the review of a business with the most votes of a kind and points
+# the business at it
+def refresh_top_review(db, business_id, vote):
+    review = db.review.find_one({"business_id": business_id},
+                                {**REVIEW_FIELDS, "_id": 0},
+                                sort=[(vote, DESCENDING)])
+    if review:
+        db.business.update_one({"business_id": business_id}, {
+            "$set": {f"top_reviews.{vote}": {
+                "review_id": review["review_id"],
+                "votes": review.get(vote, 0)}}})
+    else:
+        db.business.update_one({"business_id": business_id},
+                               {"$unset": {f"top_reviews.{vote}": ""}})
+    return review
+
+
+# Points the review's business at it for every kind of vote on which it
+# now leads, in one pipeline update
+def offer_top_review(db, review):
+    db.business.update_one(*top_review_offer(review))
+
+
+# The filter and pipeline update of offer_top_review, for bulk writes. A
+# business without a pointer is left without one: its other reviews may
+# have more votes, so top_review computes the pointer when next read.
+def top_review_offer(review):
+    pointers = {}
+    for vote in VOTES:
+        current = f"$top_reviews.{vote}"
+        pointers[f"top_reviews.{vote}"] = {"$cond": [
+            {"$eq": [{"$type": current}, "missing"]}, "$$REMOVE",
+            {"$cond": [{"$gt": [review.get(vote, 0), f"{current}.votes"]},
+                       {"$literal": {"review_id": review["review_id"],
+                                     "votes": review.get(vote, 0)}},
+                       current]}]}
+    return {"business_id": review["business_id"]}, [{"$set": pointers}]
+
+
+# Repoints the business of a deleted review at its next best reviews for
+# whichever kinds of vote the review led
+def forget_top_review(db, review):
+    business = db.business.find_one(
+        {"business_id": review["business_id"],
+         "$or": [{f"top_reviews.{vote}.review_id": review["review_id"]}
+                 for vote in VOTES]},
+        {"top_reviews": 1})
+    if business:
+        for vote, pointer in business["top_reviews"].items():
+            if pointer["review_id"] == review["review_id"]:
+                refresh_top_review(db, review["business_id"], vote)
+
+
+# Computes the top_reviews pointers of every business in one pass over
+# the review collection. $max over {votes, review_id} picks the most
+# voted review, breaking ties by review_id.
+def backfill_top_reviews(db):
+    db.review.aggregate([
+        {"$group": {"_id": "$business_id",
+                    **{vote: {"$max": {"votes": {"$ifNull": [f"${vote}", 0]},
+                                       "review_id": "$review_id"}}
+                       for vote in VOTES}}},
+        {"$project": {"_id": 0, "business_id": "$_id",
+                      "top_reviews": {vote: f"${vote}" for vote in VOTES}}},
+        {"$merge": {"into": "business", "on": "business_id",
+                    "whenMatched": "merge", "whenNotMatched": "discard"}}])
+
+
+# Returns the entries shown by a leaderboard, from its single document in
+# the leaderboards collection. A board is complete while it lists every
+# document that qualifies. One holding fewer entries than it shows is
+# only refreshed first when it is not, because entries dropped out of a
+# board that had been cut off at LEADERBOARD_SIZE.
+def read_leaderboard(db, name):
+    board = LEADERBOARDS[name]
+    document = db.leaderboards.find_one({"_id": name})
+    if document is None or (len(document["entries"]) < board["shown"] and
+                            not document.get("complete")):
+        document = {"entries": refresh_leaderboard(db, name)}
+    return document["entries"][:board["shown"]]
+
+
+# Recomputes a leaderboard from its collection and stores its top
+# LEADERBOARD_SIZE entries
+def refresh_leaderboard(db, name):
+    board = LEADERBOARDS[name]
+    entries = list(db[board["collection"]].aggregate(
+        leaderboard_pipeline(board)))
+    db.leaderboards.replace_one({"_id": name},
+                                {"entries": entries,
+                                 "complete": len(entries) < LEADERBOARD_SIZE,
+                                 "refreshed_at": datetime.now()},
+                                upsert=True)
+    return entries
+
+
+def leaderboard_pipeline(board):
+    return [{"$match": board["filter"]},
+            {"$sort": dict(board["sort"])},
+            {"$limit": LEADERBOARD_SIZE},
+            {"$project": {**board["fields"], "_id": 0}}]
+
+
+def refresh_leaderboards(db):
+    for name in LEADERBOARDS:
+        refresh_leaderboard(db, name)
+
+
+# Moves a business or user whose review stats changed to its new place on
+# the leaderboards of its collection. The boards are read in one query so
+# that only those the document is on, or now qualifies for, are written.
+def adjust_leaderboards(db, collection, document):
+    names = [name for name, board in LEADERBOARDS.items()
+             if board["collection"] == collection]
+    for stored in db.leaderboards.find({"_id": {"$in": names}}):
+        board = LEADERBOARDS[stored["_id"]]
+        key = board["key"]
+        entries = stored["entries"]
+        listed = any(entry[key] == document[key] for entry in entries)
+        qualifies = board["qualifies"](document) and (
+            len(entries) < LEADERBOARD_SIZE or
+            sort_key(document, board["sort"]) <
+            sort_key(entries[-1], board["sort"]))
+        if listed or qualifies:
+            db.leaderboards.update_one({"_id": stored["_id"]},
+                                       leaderboard_update(board, document))
+
+
+# The pipeline update replacing a document's entry on a leaderboard, or
+# removing it once the document no longer qualifies. The old entry is
+# dropped and the new one placed in the same update, so concurrent
+# writers can never list a document twice. A complete board stays so
+# unless the new entry pushes one past LEADERBOARD_SIZE.
+def leaderboard_update(board, document):
+    key = board["key"]
+    entries = {"$filter": {"input": {"$ifNull": ["$entries", []]},
+                           "cond": {"$ne": [f"$$this.{key}",
+                                            {"$literal": document[key]}]}}}
+    if not board["qualifies"](document):
+        return [{"$set": {"entries": entries}}]
+    entry = {field: document.get(field) for field in board["fields"]}
+    return [{"$set": {"entries": {"$sortArray": {
+                "input": {"$concatArrays": [entries, [{"$literal": entry}]]},
+                "sortBy": dict(board["sort"])}}}},
+            {"$set": {"complete": {"$and": [
+                {"$ifNull": ["$complete", False]},
+                {"$lte": [{"$size": "$entries"}, LEADERBOARD_SIZE]}]},
+                "entries": {"$slice": ["$entries", LEADERBOARD_SIZE]}}}]
+
+
+# Orders documents the way a leaderboard's sort specification does
+def sort_key(document, sort):
+    return tuple(direction * (document.get(field) or 0)
+                 for field, direction in sort)
+
+
+# Applies a review write to the running totals of its author and business.
+# Each document keeps the sum of its review stars next to review_count, so
+# the new average is derived server-side in one atomic update instead of
+# re-reading every review. Returns the updated user and business.
+def update_review_stats(db, user_id, business_id, stars_delta, count_delta):
+    user = db.user.find_one_and_update(
+        {"user_id": user_id},
+        running_average_update("average_stars", stars_delta, count_delta),
+        USER_FIELDS, return_document=ReturnDocument.AFTER)
+    business = db.business.find_one_and_update(
+        {"business_id": business_id},
+        running_average_update("stars", stars_delta, count_delta,
+                               half_stars=True),
+        BUSINESS_FIELDS, return_document=ReturnDocument.AFTER)
+    if user:
+        adjust_leaderboards(db, "user", user)
+    if business:
+        adjust_leaderboards(db, "business", business)
+    return user, business
+
+
+def running_average_update(average_field, stars_delta, count_delta,
+                           half_stars=False):
+    # Documents created before stars_total existed are seeded from their
+    # stored average and count.
+    seed_total = {"$multiply": [{"$ifNull": [f"${average_field}", 0]},
+                                {"$ifNull": ["$review_count", 0]}]}
+    average = {"$cond": [{"$gt": ["$review_count", 0]},
+                         {"$divide": ["$stars_total", "$review_count"]}, 0]}
+    if half_stars:
+        # Business ratings are shown in half stars, like the Yelp dataset
+        average = {"$divide": [{"$round": [{"$multiply": [average, 2]}, 0]},
+                               2]}
+    return [{"$set": {"stars_total": {"$add": [{"$ifNull": ["$stars_total",
+                                                            seed_total]},
+                                               stars_delta]},
+                      "review_count": {"$add": [{"$ifNull": ["$review_count",
+                                                             0]},
+                                                count_delta]}}},
+            {"$set": {average_field: average}}]
+
+
+# The stats of a business's reviews, from one aggregation that groups
+# them by stars and month reading only the keys of the Query 12 index
+def business_review_stats(db, business_id):
+    groups = db.review.aggregate([
+        {"$match": {"business_id": business_id}},
+        {"$group": {"_id": {"stars": "$stars",
+                            "month": {"$substrCP": ["$date", 0, 7]}},
+                    "count": {"$sum": 1}}}])
+    return patch_review_stats(
+        {"business_id": business_id, "stars": [0] * 5, "months": {}},
+        [(group["_id"]["stars"], group["_id"]["month"], group["count"])
+         for group in groups])
+
+
+# Stats with count reviews of the given stars and date added for each
+# (stars, date, count) change; count is negative for removed reviews
+def patch_review_stats(stats, changes):
+    stars, months = list(stats["stars"]), dict(stats["months"])
+    for review_stars, review_date, count in changes:
+        stars[min(5, max(1, round(float(review_stars)))) - 1] += count
+        month = str(review_date or "")[:7]
+        if month:
+            months[month] = months.get(month, 0) + count
+            if months[month] <= 0:
+                del months[month]
+    return {**stats, "stars": stars, "months": dict(sorted(months.items()))}
+
+
+# Recomputes every user's and business's review_count, stars_total and
+# average rating from the review collection, correcting any drift in the
+# running totals. Each document looks up its own reviews, so those with
+# none left are reset to zero rather than keeping stale totals. The
+# leaderboards are then recomputed from the repaired totals.
+def repair_review_stats(db):
+    for collection, key, average_field, half_stars in (
+            ("user", "user_id", "average_stars", False),
+            ("business", "business_id", "stars", True)):
+        average = {"$cond": [{"$gt": ["$review_count", 0]},
+                             {"$divide": ["$stars_total", "$review_count"]},
+                             0]}
+        if half_stars:
+            average = {"$divide": [{"$round": [{"$multiply": [average, 2]},
+                                               0]}, 2]}
+        db[collection].aggregate([
+            {"$lookup": {"from": "review", "localField": key,
+                         "foreignField": key, "as": "totals",
+                         "pipeline": [{"$group": {
+                             "_id": None,
+                             "stars_total": {"$sum": {"$convert": {
+                                 "input": "$stars", "to": "double",
+                                 "onError": 0, "onNull": 0}}},
+                             "review_count": {"$sum": 1}}}]}},
+            {"$project": {field: {"$ifNull": [
+                {"$arrayElemAt": [f"$totals.{field}", 0]}, 0]}
+                for field in ("stars_total", "review_count")}},
+            {"$set": {average_field: average}},
+            {"$merge": {"into": collection, "on": "_id",
+                        "whenMatched": "merge",
+                        "whenNotMatched": "discard"}}])
+    refresh_leaderboards(db)
+
+
+# Fetches one page of a listing ordered by (sort_field, _id). Pages are
+# addressed by the boundary document of the neighbouring page rather than
+# by skip, so every page costs the same index range scan no matter how
+# deep it is. Returns the page and whether more results lie beyond it in
+# the direction of travel.
+def fetch_page(collection, query, sort_field, projection, descending=False,
+               after=None, before=None, page_size=PAGE_SIZE):
+    query, sort = page_query(query, sort_field, descending, after, before)
+    page = list(collection.find(query, projection).sort(sort)
+                .limit(page_size + 1))
+    has_more = len(page) > page_size
+    page = page[:page_size]
+    if before is not None:
+        page.reverse()
+    return page, has_more
+
+
+# The query and sort order fetch_page reads a page with: the listing's
+# query limited to the documents past the boundary document, if any, in
+# (sort_field, _id) order
+def page_query(query, sort_field, descending=False, after=None,
+               before=None):
+    direction = DESCENDING if descending else ASCENDING
+    if before is not None:
+        direction = -direction
+    boundary = after if after is not None else before
+    if boundary is not None:
+        operator = "$gt" if direction == ASCENDING else "$lt"
+        key = boundary.get(sort_field)
+        query = {"$and": [query, {"$or": [
+            {sort_field: {operator: key}},
+            {sort_field: key, "_id": {operator: boundary["_id"]}}]}]}
+    return query, [(sort_field, direction), ("_id", direction)]
+
+
+# Runs a search in a single round trip, returning its first page, whether
+# more results follow and the number of matches capped at count_cap + 1.
+# The matches are read once and the scan stops after count_cap + 1
+# documents, so an empty result needs no separate count query and a broad
+# search is never counted in full.
+def run_search(collection, query, sort_field, projection, descending=False,
+               count_cap=SEARCH_COUNT_CAP, page_size=PAGE_SIZE):
+    result = next(collection.aggregate(search_pipeline(
+        query, sort_field, projection, descending, count_cap, page_size)))
+    page = result["page"]
+    count = result["count"][0]["total"] if result["count"] else 0
+    return page[:page_size], len(page) > page_size, count
+
+
+def search_pipeline(query, sort_field, projection, descending=False,
+                    count_cap=SEARCH_COUNT_CAP, page_size=PAGE_SIZE):
+    direction = DESCENDING if descending else ASCENDING
+    return [{"$match": query},
+            {"$sort": {sort_field: direction, "_id": direction}},
+            {"$limit": max(count_cap, page_size) + 1},
+            {"$facet": {"page": [{"$limit": page_size + 1},
+                                 {"$project": projection}],
+                        "count": [{"$limit": count_cap + 1},
+                                  {"$count": "total"}]}}]
+
+
+# Page tokens carry the (sort key, _id) of a page's boundary document
+def page_token(document, sort_field):
+    boundary = json.dumps([document.get(sort_field), str(document["_id"])])
+    return base64.urlsafe_b64encode(boundary.encode()).decode()
+
+
+def offset_token(offset):
+    return base64.urlsafe_b64encode(json.dumps(offset).encode()).decode()
+
+
+def decode_offset_token(token):
+    if token is None:
+        return 0
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(token))
+    except (TypeError, ValueError):
+        raise ValueError("invalid page token")
+    if not isinstance(offset, int) or not 0 <= offset <= SEARCH_COUNT_CAP:
+        raise ValueError("invalid page token")
+    return offset
+
+
+def decode_page_token(token, sort_field):
+    if token is None:
+        return None
+    try:
+        key, object_id = json.loads(base64.urlsafe_b64decode(token))
+        return {sort_field: key, "_id": ObjectId(object_id)}
+    except (TypeError, ValueError, InvalidId):
+        raise ValueError("invalid page token")
+
+
+# Fields derived from a business document so that searches can be served
+# from indexes instead of scanning the raw strings or coordinates
+def business_search_fields(business):
+    name_key = normalize_name(business.get("name") or "")
+    fields = {"name_key": name_key,
+              "name_words": sorted(set(name_key.split())),
+              "category_tokens": category_tokens(business.get("categories"))}
+    if business.get("latitude") is not None and \
+            business.get("longitude") is not None:
+        try:
+            fields["location"] = geo_point(business["latitude"],
+                                           business["longitude"])
+        except ValueError:
+            pass
+    return fields
+
+
+# Lowercases a name and strips its punctuation, so "McDonald's" and
+# "mcdonalds" normalize alike
+def normalize_name(name):
+    return " ".join(re.sub(r"[^\w\s]", "", name.lower()).split())
+
+
+def category_tokens(categories):
+    if not categories:
+        return []
+    return sorted({token.strip().lower() for token in categories.split(",")
+                   if token.strip()})
+
+
+# Computes the search fields of every business, for documents loaded
+# before they existed or after their source fields were edited
+def backfill_business_search_fields(db, batch_size=1000):
+    updated = 0
+    businesses = db.business.find({}, {"name": 1, "categories": 1,
+                                       "latitude": 1, "longitude": 1})
+    for batch in batches(businesses, batch_size):
+        db.business.bulk_write(
+            [UpdateOne({"_id": business["_id"]},
+                       {"$set": business_search_fields(business)})
+             for business in batch], ordered=False)
+        updated += len(batch)
+    return updated
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Random bytes are mapped onto the 62 characters four times over, and the
+# 8 bytes left over are dropped, so every character is equally likely
+ID_TABLE = bytes.maketrans(bytes(range(248)), ID_ALPHABET.encode() * 4)
+ID_REJECTED = bytes(range(248, 256))
+
+
+# Returns count ids of ID_LENGTH base62 characters, drawn in one block
+# from the operating system's CSPRNG
+def generate_ids(count):
+    needed = count * ID_LENGTH
+    characters = b""
+    while len(characters) < needed:
+        # One byte in 32 is dropped, so a little more is drawn
+        characters += os.urandom(needed - len(characters) + needed // 16 +
+                                 8).translate(ID_TABLE, ID_REJECTED)
+    characters = characters[:needed].decode("ascii")
+    return [characters[start:start + ID_LENGTH]
+            for start in range(0, needed, ID_LENGTH)]
+
+
+def generate_id():
+    return generate_ids(1)[0]
+
+
+def token_digest(token):
+    return hashlib.sha256(str(token).encode()).hexdigest()
+
+
+# Inserts a document, drawing a new id for its key field whenever the one
+# it has is already taken
+def insert_with_new_id(collection, document, key):
+    for attempt in range(1, ID_ATTEMPTS + 1):
+        try:
+            return collection.insert_one(document)
+        except DuplicateKeyError as error:
+            if attempt == ID_ATTEMPTS or not duplicate_of(error.details,
+                                                          key):
+                raise
+            document[key] = generate_id()
+
+
+# Whether a write error is a clash on the unique index of the key field
+def duplicate_of(error, key):
+    error = error or {}
+    return error.get("code") == DUPLICATE_KEY and (
+        list(error.get("keyPattern") or {}) == [key] or
+        f"{key}_1" in error.get("errmsg", ""))
+
+
+# Returns the indexes of the manifest that the database lacks, by
+# collection, and builds them on a background thread so that startup does
+# not wait on them unless wait is set.
+def ensure_indexes(db, wait=False):
+    missing = {}
+    for collection, indexes in INDEXES.items():
+        existing = {index_key(index["key"])
+                    for index in db[collection].list_indexes()}
+        absent = [index for index in indexes
+                  if index_key(index.document["key"]) not in existing]
+        if absent:
+            missing[collection] = absent
+
+    if missing:
+        builder = threading.Thread(target=build_indexes, args=(db, missing),
+                                   daemon=True)
+        builder.start()
+        if wait:
+            builder.join()
+    return missing
+
+
+def build_indexes(db, indexes):
+    for collection, models in indexes.items():
+        db[collection].create_indexes(models)
+
+
+# Key specification of an index as a hashable tuple; the server may report
+# numeric directions as floats
+def index_key(key):
+    return tuple((field, int(direction) if isinstance(direction, (int, float))
+                  else direction) for field, direction in key.items())
+
+
+# The commands the numbered queries send, built by the same functions the
+# service builds them with and filled with sample values from the
+# database. Listings are explained both for their first page and for the
+# keyset page after a sample document. Each entry also says whether the
+# query may sort in memory: searches that match a range of name or
+# category tokens cannot read their results in name order from an index,
+# and sort the matches of one location instead.
+def numbered_query_plans(db):
+    business = db.business.find_one() or {"_id": ObjectId()}
+    user = db.user.find_one() or {"_id": ObjectId()}
+    review = db.review.find_one() or {"_id": ObjectId()}
+    business_id = business.get("business_id", "")
+    user_id = user.get("user_id", "")
+    city_state = {"city": business.get("city", ""),
+                  "state": business.get("state", "")}
+    zipcode = {"zipcode": business.get("postal_code", "")}
+    name = business.get("name", "")
+    category = (business.get("category_tokens") or [""])[0]
+
+    plans = [("Login", find_command(
+        "user", {"name": user.get("name", ""),
+                 "password": user.get("password", "")},
+        {**USER_FIELDS, "_id": 0}, limit=1), False)]
+    for label, location in (("city & state", city_state),
+                            ("zipcode", zipcode)):
+        for search, filters, sort, may_sort in (
+                ("Query 4", {"name": name}, "name", True),
+                ("Query 5", {"category": category}, "name", True),
+                ("Query 6", {"rating": business.get("stars", 0)}, "name",
+                 False),
+                ("Advanced search by stars",
+                 {"min_stars": 4, "max_stars": 5, "min_reviews": 50},
+                 "stars", False),
+                ("Advanced search by reviews",
+                 {"min_stars": 4, "min_reviews": 50}, "review_count",
+                 False)):
+            plans += listing_plans(
+                f"{search} ({label})", "business",
+                search_filter(location, **filters), *BUSINESS_SORTS[sort],
+                BUSINESS_FIELDS, business, may_sort, search=True)
+    plans += listing_plans("Query 7", "user", {"name": user.get("name", "")},
+                           "name", False, USER_FIELDS, user, search=True)
+    for board_name, board in LEADERBOARDS.items():
+        plans += [
+            (board["query"], find_command(
+                "leaderboards", {"_id": board_name}, limit=1), False),
+            (f"{board['query']} (refresh)", aggregate_command(
+                board["collection"], leaderboard_pipeline(board)), False)]
+    plans += listing_plans("Query 10", "review", {"user_id": user_id},
+                           "date", True, REVIEW_LISTING_FIELDS, review)
+    plans += [("Query 11", find_command("user", {"user_id": user_id},
+                                        USER_FIELDS, limit=1), False)]
+    plans += listing_plans("Query 12", "review",
+                           {"business_id": business_id}, "date", True,
+                           REVIEW_LISTING_FIELDS, review)
+    plans += [(TOP_REVIEW_QUERIES[vote], find_command(
+        "review", {"business_id": business_id}, {**REVIEW_FIELDS, "_id": 0},
+        [(vote, DESCENDING)], limit=1), False) for vote in VOTES]
+    plans += [
+        ("Query 18", find_command("business", {"business_id": business_id},
+                                  BUSINESS_FIELDS, limit=1), False),
+        ("Queries 19 & 20", find_command(
+            "review", {"review_id": review.get("review_id", ""),
+                       "user_id": user_id}, REVIEW_FIELDS, limit=1), False)]
+    return plans
+
+
+# The first page of a listing, as the aggregation of run_search when it is
+# a search and the find of fetch_page otherwise, and the page after the
+# boundary document
+def listing_plans(label, collection, query, sort_field, descending,
+                  projection, boundary, may_sort=False, search=False):
+    if search:
+        first = aggregate_command(collection, search_pipeline(
+            query, sort_field, projection, descending))
+    else:
+        first = page_command(collection, query, sort_field, projection,
+                             descending)
+    return [(label, first, may_sort),
+            (f"{label} (next page)", page_command(
+                collection, query, sort_field, projection, descending,
+                after=boundary), may_sort)]
+
+
+def page_command(collection, query, sort_field, projection, descending,
+                 after=None):
+    query, sort = page_query(query, sort_field, descending, after)
+    return find_command(collection, query, projection, sort, PAGE_SIZE + 1)
+
+
+def find_command(collection, query, projection=None, sort=None,
+                 limit=None):
+    command = {"find": collection, "filter": query}
+    if projection:
+        command["projection"] = projection
+    if sort:
+        command["sort"] = dict(sort)
+    if limit:
+        command["limit"] = limit
+    return command
+
+
+def aggregate_command(collection, pipeline):
+    return {"aggregate": collection, "pipeline": pipeline, "cursor": {}}
+
+
+# Explains every numbered query and reports any that scans a whole
+# collection or sorts in memory when it should not. Returns True if every
+# plan is index-backed.
+def check_query_plans(db):
+    passed = True
+    for label, command, may_sort in numbered_query_plans(db):
+        problems = plan_problems(db, command, may_sort)
+        if problems:
+            passed = False
+            print(f"{label}: FAILED ({', '.join(problems)})")
+        else:
+            print(f"{label}: OK")
+    return passed
+
+
+# The stages of a command's winning plan that scan a whole collection, or
+# sort in memory unless the command may
+def plan_problems(db, command, may_sort=False):
+    stages = plan_stages(db.command("explain", command,
+                                    verbosity="queryPlanner"))
+    return [stage for stage in ("COLLSCAN", "SORT")
+            if stage in stages and not (stage == "SORT" and may_sort)]
+
+
+# Every stage of the winning plan, including those on each shard
+def plan_stages(plan):
+    stages = set()
+    if isinstance(plan, dict):
+        for key, value in plan.items():
+            if key == "stage":
+                stages.add(value)
+            elif key not in ("rejectedPlans", "allPlansExecution"):
+                stages |= plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            stages |= plan_stages(item)
+    return stages
@@ -0,0 +1,53 @@
+# ----------------------------------------------------------------------
+# Name:        session
+# Purpose:     The user logged in to the command line menus. A session
+#              is made from the user record the login query returns and
+#              keeps that profile current from the documents the user's
+#              own writes return, so the menus never read the user again
+#              while they are logged in.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+import threading
+
+from records import User
+
+
+# A logged-in user and the service their menus query. Each session holds
+# its own copy of the user, so any number of them can run concurrently on
+# one service. The writes of a session are made one at a time, so its
+# profile is always the one its latest write left in the database. Votes
+# other users cast on the user's reviews show from their next login.
+class Session:
+    def __init__(self, service, user):
+        self.service = service
+        self.user = user
+        self.lock = threading.Lock()
+
+    @property
+    def user_id(self):
+        return self.user.user_id
+
+    # Query 18: Create a review for a business
+    def create_review(self, business_id, stars, text):
+        with self.lock:
+            return self.service.create_review(self.user_id, business_id,
+                                              stars, text, session=self)
+
+    # Query 19: Update a review you made for a business
+    def update_review(self, review_id, stars, text):
+        with self.lock:
+            return self.service.update_review(self.user_id, review_id,
+                                              stars, text, session=self)
+
+    # Query 20: Delete a review you made for a business
+    def delete_review(self, review_id):
+        with self.lock:
+            return self.service.delete_review(self.user_id, review_id,
+                                              session=self)
+
+    # Copies the user's fields from a user document in place
+    def update(self, user):
+        for field in User.fields:
+            if field in user:
+                setattr(self.user, field, user[field])
@@ -0,0 +1,157 @@
+# ----------------------------------------------------------------------
+# Name:        similarity
+# Purpose:     Recommends businesses like one a user is looking at. An
+#              offline job encodes every business's categories, stars
+#              and location as a row of a float32 matrix on disk, with
+#              the businesses of each city in consecutive rows. A
+#              recommendation maps the matrix into memory and scores the
+#              business's whole city with one matrix-vector product.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+from collections import Counter
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+
+from snapshot import write_json
+
+SIMILARITY_VERSION = 1
+CATEGORY_DIMENSIONS = 256  # most common categories encoded; rarer ignored
+KM_PER_DEGREE = 111.2  # of latitude, and of longitude at the equator
+
+# Businesses are points in a space where the squared distance between two
+# is the squared distance between their unit category vectors (0 to 2)
+# plus these weights times their difference in stars and in km, squared.
+# Two stars apart then count as much as entirely different categories.
+STARS_WEIGHT = 0.7
+KM_WEIGHT = 0.2
+
+
+# Writes the business vectors of the database to the given directory,
+# replacing any already there once the new ones are complete. Returns the
+# number of businesses written.
+def build_similarity(db, directory):
+    staging = directory.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    cities, category_counts = {}, Counter()
+    for business in db.business.find({}, {"_id": 0, "business_id": 1,
+                                          "city": 1, "state": 1,
+                                          "categories": 1, "stars": 1,
+                                          "latitude": 1, "longitude": 1}):
+        categories = {category.strip() for category in
+                      (business.get("categories") or "").split(",")
+                      if category.strip()}
+        category_counts.update(categories)
+        city = f"{business.get('city')}, {business.get('state')}"
+        cities.setdefault(city, []).append(
+            (business["business_id"], categories,
+             business.get("stars") or 0, business.get("latitude"),
+             business.get("longitude")))
+    category_index = {category: index for index, (category, _) in
+                      enumerate(category_counts.most_common(
+                          CATEGORY_DIMENSIONS))}
+
+    business_ids, offsets = [], [0]
+    with open(os.path.join(staging, "vectors.bin"), "wb") as vectors, \
+            open(os.path.join(staging, "norms.bin"), "wb") as norms:
+        for businesses in cities.values():
+            rows = city_vectors(businesses, category_index)
+            rows.tofile(vectors)
+            np.einsum("ij,ij->i", rows, rows).tofile(norms)
+            business_ids.extend(business[0] for business in businesses)
+            offsets.append(len(business_ids))
+    np.array(offsets, dtype=np.int64).tofile(
+        os.path.join(staging, "city_offsets.bin"))
+
+    write_json(staging, "businesses.json", business_ids)
+    write_json(staging, "cities.json", list(cities))
+    write_json(staging, "manifest.json", {
+        "version": SIMILARITY_VERSION, "businesses": len(business_ids),
+        "cities": len(cities), "dimensions": vector_dimensions()})
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(staging, directory)
+    return len(business_ids)
+
+
+def vector_dimensions():
+    return CATEGORY_DIMENSIONS + 3
+
+
+# The vectors of one city's businesses: their categories as a unit vector,
+# then their weighted stars and their weighted km east and north of the
+# middle of the city. Businesses without a location are put in the middle.
+def city_vectors(businesses, category_index):
+    rows = np.zeros((len(businesses), vector_dimensions()), dtype=np.float32)
+    for row, (_, categories, stars, _, _) in enumerate(businesses):
+        columns = [category_index[category] for category in categories
+                   if category in category_index]
+        if columns:
+            rows[row, columns] = 1 / math.sqrt(len(columns))
+        rows[row, CATEGORY_DIMENSIONS] = STARS_WEIGHT * stars
+
+    located = [(row, latitude, longitude) for row, (*_, latitude, longitude)
+               in enumerate(businesses)
+               if latitude is not None and longitude is not None]
+    if located:
+        located = np.array(located, dtype=np.float64)
+        latitudes, longitudes = located[:, 1], located[:, 2]
+        east = (longitudes - longitudes.mean()) * KM_PER_DEGREE * \
+            math.cos(math.radians(latitudes.mean()))
+        north = (latitudes - latitudes.mean()) * KM_PER_DEGREE
+        indexes = located[:, 0].astype(np.int64)
+        rows[indexes, CATEGORY_DIMENSIONS + 1] = KM_WEIGHT * east
+        rows[indexes, CATEGORY_DIMENSIONS + 2] = KM_WEIGHT * north
+    return rows
+
+
+# The business vectors written by build_similarity, mapped into memory
+class SimilarBusinesses:
+    def __init__(self, directory):
+        with open(os.path.join(directory, "manifest.json")) as file:
+            manifest = json.load(file)
+        if manifest["version"] != SIMILARITY_VERSION:
+            raise ValueError(f"similarity version {manifest['version']} "
+                             f"is not supported")
+        with open(os.path.join(directory, "businesses.json")) as file:
+            self.business_ids = json.load(file)
+        self.rows = {business_id: row for row, business_id
+                     in enumerate(self.business_ids)}
+        count = manifest["businesses"]
+        self.vectors = matrix_map(directory, "vectors", np.float32,
+                                  (count, manifest["dimensions"]))
+        self.norms = matrix_map(directory, "norms", np.float32, (count,))
+        self.city_offsets = np.fromfile(
+            os.path.join(directory, "city_offsets.bin"), dtype=np.int64)
+
+    # The ids of up to limit other businesses in the business's city,
+    # nearest first, or None if the business was not encoded
+    def similar(self, business_id, limit):
+        row = self.rows.get(business_id)
+        if row is None:
+            return None
+        city = int(np.searchsorted(self.city_offsets, row, side="right")) - 1
+        start, end = self.city_offsets[city], self.city_offsets[city + 1]
+        limit = min(limit, end - start - 1)
+        if limit <= 0:
+            return []
+        # Squared distances to the business, less its own squared norm,
+        # which is the same for every candidate
+        distances = self.norms[start:end] - 2 * (self.vectors[start:end] @
+                                                 self.vectors[row])
+        distances[row - start] = np.inf
+        nearest = np.argpartition(distances, limit - 1)[:limit]
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+        return [self.business_ids[start + index] for index in nearest]
+
+
+def matrix_map(directory, name, dtype, shape):
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(os.path.join(directory, f"{name}.bin"), dtype=dtype,
+                     mode="r", shape=shape)
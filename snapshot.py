@@ -0,0 +1,139 @@
+# ----------------------------------------------------------------------
+# Name:        snapshot
+# Purpose:     Exports the review collection as a columnar snapshot: one
+#              flat binary file per field, which NumPy maps into memory
+#              so that analytics can scan millions of reviews as arrays
+#              without touching the database. Businesses and users are
+#              dictionary encoded as indexes into the lists of their ids.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+import json
+import os
+import shutil
+
+import numpy as np
+
+from reviews_service import batches
+
+SNAPSHOT_VERSION = 1
+MISSING = -1  # index of a business or user the snapshot does not know
+EPOCH = np.datetime64("1970-01-01", "D")
+
+# Columns of the snapshot and their types. Review columns have a row per
+# review and business columns a row per business; dates are days since
+# 1970-01-01.
+REVIEW_COLUMNS = {"stars": np.int8, "useful": np.int32, "funny": np.int32,
+                  "cool": np.int32, "date": np.int32,
+                  "business": np.int32, "user": np.int32}
+BUSINESS_COLUMNS = {"city": np.int32, "category_offsets": np.int64,
+                    "categories": np.int32}
+
+
+# Writes a snapshot of the database's reviews to the given directory,
+# replacing any snapshot already there once the new one is complete.
+# Returns the number of reviews written.
+def export_snapshot(db, directory, batch_size=100000):
+    staging = directory.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    business_ids, cities, categories = export_businesses(db, staging)
+    business_index = {business_id: index
+                      for index, business_id in enumerate(business_ids)}
+    user_index = {}
+    files = {column: open(os.path.join(staging, f"{column}.bin"), "wb")
+             for column in REVIEW_COLUMNS}
+    rows = 0
+    try:
+        reviews = db.review.find({}, {"_id": 0, "stars": 1, "useful": 1,
+                                      "funny": 1, "cool": 1, "date": 1,
+                                      "business_id": 1, "user_id": 1},
+                                 batch_size=10000)
+        for batch in batches(reviews, batch_size):
+            columns = review_columns(batch, business_index, user_index)
+            for column, values in columns.items():
+                values.astype(REVIEW_COLUMNS[column]).tofile(files[column])
+            rows += len(batch)
+            print(f"{rows} reviews exported...")
+    finally:
+        for file in files.values():
+            file.close()
+
+    write_json(staging, "users.json", list(user_index))
+    write_json(staging, "manifest.json", {
+        "version": SNAPSHOT_VERSION, "reviews": rows,
+        "businesses": len(business_ids), "users": len(user_index),
+        "cities": len(cities), "categories": len(categories)})
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(staging, directory)
+    return rows
+
+
+# Writes every business's city and categories, as indexes into the lists
+# of distinct cities and categories, and returns the three lists
+def export_businesses(db, directory):
+    business_ids, city_codes, offsets, category_codes = [], [], [0], []
+    city_index, category_index = {}, {}
+    for business in db.business.find({}, {"_id": 0, "business_id": 1,
+                                          "city": 1, "state": 1,
+                                          "categories": 1}):
+        business_ids.append(business["business_id"])
+        city = f"{business.get('city')}, {business.get('state')}"
+        city_codes.append(city_index.setdefault(city, len(city_index)))
+        for category in {category.strip() for category in
+                         (business.get("categories") or "").split(",")
+                         if category.strip()}:
+            category_codes.append(category_index.setdefault(
+                category, len(category_index)))
+        offsets.append(len(category_codes))
+
+    for column, values in (("city", city_codes),
+                           ("category_offsets", offsets),
+                           ("categories", category_codes)):
+        np.array(values, dtype=BUSINESS_COLUMNS[column]).tofile(
+            os.path.join(directory, f"{column}.bin"))
+    write_json(directory, "businesses.json", business_ids)
+    write_json(directory, "cities.json", list(city_index))
+    write_json(directory, "categories.json", list(category_index))
+    return business_ids, list(city_index), list(category_index)
+
+
+# Converts a batch of reviews to arrays, one per review column. Users are
+# numbered in the order they are first seen.
+def review_columns(batch, business_index, user_index):
+    columns = {column: np.array([review.get(column) or 0
+                                 for review in batch])
+               for column in ("stars", "useful", "funny", "cool")}
+    columns["date"] = day_numbers([str(review.get("date") or "")[:10]
+                                   for review in batch])
+    columns["business"] = np.array([business_index.get(
+        review["business_id"], MISSING) for review in batch])
+    columns["user"] = np.array([user_index.setdefault(
+        review["user_id"], len(user_index)) for review in batch])
+    return columns
+
+
+# Days since 1970-01-01 of "YYYY-MM-DD" dates; unreadable dates become the
+# smallest int32
+def day_numbers(dates):
+    try:
+        days = np.array(dates, dtype="datetime64[D]")
+    except ValueError:
+        days = np.array([parse_day(date) for date in dates],
+                        dtype="datetime64[D]")
+    numbers = (days - EPOCH).astype(np.int64)
+    numbers[np.isnat(days)] = np.iinfo(np.int32).min
+    return numbers
+
+
+def parse_day(date):
+    try:
+        return np.datetime64(date, "D")
+    except ValueError:
+        return np.datetime64("NaT")
+
+
+def write_json(directory, name, value):
+    with open(os.path.join(directory, name), "w") as file:
+        json.dump(value, file)
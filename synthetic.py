@@ -0,0 +1,199 @@
+# ----------------------------------------------------------------------
+# Name:        synthetic
+# Purpose:     Generates businesses, users and reviews shaped like Yelp's
+#              public dataset, for benchmarking without the real files.
+#              The data is deterministic for a given seed and skewed the
+#              way the real data is: a few businesses and users account
+#              for most reviews, businesses cluster in a few cities and
+#              review texts have a long tail of lengths.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+from datetime import date, timedelta
+import itertools
+import json
+import os
+import random
+import string
+
+from loader import LOAD_ORDER, insert_batch, normalize
+from reviews_service import batches, ensure_indexes, refresh_leaderboards
+
+ZIPF_EXPONENT = 1.1  # skew of reviews across businesses and users
+MEAN_REVIEW_WORDS = 110  # median length of a review's text, in words
+MAX_REVIEW_WORDS = 1000  # Yelp caps reviews at 5,000 characters
+FIRST_REVIEW_DATE = date(2005, 1, 1)
+LAST_REVIEW_DATE = date(2022, 1, 1)
+PASSWORD = "synthetic"  # password of every generated user
+
+# (city, state, latitude, longitude, zipcode prefix), most popular first
+CITIES = [("Philadelphia", "PA", 39.95, -75.16, "191"),
+          ("Tucson", "AZ", 32.22, -110.97, "857"),
+          ("Tampa", "FL", 27.95, -82.46, "336"),
+          ("Indianapolis", "IN", 39.77, -86.16, "462"),
+          ("Nashville", "TN", 36.16, -86.78, "372"),
+          ("New Orleans", "LA", 29.95, -90.07, "701"),
+          ("Reno", "NV", 39.53, -119.81, "895"),
+          ("Edmonton", "AB", 53.55, -113.49, "T5"),
+          ("Saint Louis", "MO", 38.63, -90.20, "631"),
+          ("Santa Barbara", "CA", 34.42, -119.70, "931"),
+          ("Boise", "ID", 43.62, -116.21, "837"),
+          ("Clearwater", "FL", 27.97, -82.80, "337")]
+CATEGORIES = ["Restaurants", "Food", "Shopping", "Home Services",
+              "Beauty & Spas", "Nightlife", "Bars", "Health & Medical",
+              "Local Services", "Automotive", "Coffee & Tea", "Pizza",
+              "Mexican", "Sandwiches", "Hair Salons", "Barbers", "Bakeries",
+              "Fast Food", "Italian", "Chinese", "Burgers", "Breakfast & "
+              "Brunch", "Event Planning & Services", "Active Life"]
+NAME_WORDS = ["Golden", "Blue", "Red", "Happy", "Lucky", "Royal", "Green",
+              "Little", "Big", "Old Town", "Sunset", "Main Street",
+              "Corner", "Urban", "Rustic", "Silver", "Twin", "Garden"]
+NAME_KINDS = ["Cafe", "Grill", "Kitchen", "Pizza", "Barbershop", "Salon",
+              "Bakery", "Tavern", "Diner", "Market", "Auto Repair",
+              "Bistro", "Taqueria", "Coffee", "Boutique", "Spa"]
+STREETS = ["Main St", "Market St", "Broadway", "Oak Ave", "Pine St",
+           "Elm St", "Maple Ave", "Washington Ave", "Park Blvd", "2nd St"]
+FIRST_NAMES = ["Mary", "John", "Jennifer", "Michael", "Linda", "David",
+               "Sarah", "James", "Jessica", "Robert", "Karen", "Daniel",
+               "Lisa", "Chris", "Emily", "Kevin", "Ashley", "Brian",
+               "Nicole", "Jason", "Amanda", "Eric", "Stephanie", "Matt"]
+WORDS = ("the food service was great good friendly staff place really "
+         "would come back again time order ordered delicious definitely "
+         "recommend best nice amazing love got came menu chicken lunch "
+         "dinner wait price prices little bit table experience fresh "
+         "restaurant went try well made also never service slow rude "
+         "clean spot favorite awesome excellent atmosphere decent drinks "
+         "appointment hair cut car fixed quickly helpful professional "
+         "price reasonable location parking busy weekend visit again").split()
+
+
+# Generates a dataset with the given number of businesses, users and
+# reviews. Returns a dict of collection name to records, in the layout of
+# the dataset's NDJSON files plus the running totals the application
+# keeps. Businesses and users are lists; reviews are produced lazily so
+# their texts never all sit in memory.
+def generate_dataset(businesses=1000, users=5000, reviews=20000, seed=0):
+    rng = random.Random(seed)
+    business_docs = [generate_business(rng, number)
+                     for number in range(businesses)]
+    user_docs = [generate_user(rng, number) for number in range(users)]
+
+    # Reviews are planned first, as (business, user, stars, votes, date)
+    # rows, so the totals of every business and user are known before
+    # any of them is written
+    business_picks = zipf_choices(rng, businesses, reviews)
+    user_picks = zipf_choices(rng, users, reviews)
+    plans = []
+    for business, user in zip(business_picks, user_picks):
+        stars = min(5, max(1, round(rng.gauss(
+            business_docs[business]["quality"], 1.2))))
+        votes = [min(int(rng.paretovariate(1.6)) - 1, 500)
+                 for _ in range(3)]
+        day = FIRST_REVIEW_DATE + timedelta(days=rng.randrange(
+            (LAST_REVIEW_DATE - FIRST_REVIEW_DATE).days))
+        plans.append((business, user, stars, votes, day))
+
+    for business, user, stars, votes, _ in plans:
+        for document in (business_docs[business], user_docs[user]):
+            document["review_count"] += 1
+            document["stars_total"] += stars
+        for field, count in zip(("useful", "funny", "cool"), votes):
+            user_docs[user][field] += count
+    for document in business_docs:
+        quality = document.pop("quality")
+        average = (document["stars_total"] / document["review_count"]
+                   if document["review_count"] else quality)
+        document["stars"] = round(average * 2) / 2
+    for document in user_docs:
+        document["average_stars"] = round(
+            document["stars_total"] / document["review_count"], 2) \
+            if document["review_count"] else 0
+
+    return {"business": business_docs, "user": user_docs,
+            "review": generate_reviews(seed, plans, business_docs,
+                                       user_docs)}
+
+
+def generate_business(rng, number):
+    city, state, latitude, longitude, zipcode = CITIES[zipf_choices(
+        rng, len(CITIES), 1)[0]]
+    name = f"{rng.choice(NAME_WORDS)} {rng.choice(NAME_KINDS)}"
+    return {"business_id": random_id(rng), "name": name,
+            "address": f"{rng.randrange(1, 9999)} {rng.choice(STREETS)}",
+            "city": city, "state": state,
+            "postal_code": zipcode + "".join(
+                rng.choice(string.digits) for _ in range(5 - len(zipcode))),
+            "latitude": round(latitude + rng.gauss(0, 0.05), 6),
+            "longitude": round(longitude + rng.gauss(0, 0.05), 6),
+            "is_open": int(rng.random() < 0.8),
+            "categories": ", ".join(rng.sample(CATEGORIES,
+                                               rng.randint(1, 4))),
+            "review_count": 0, "stars_total": 0,
+            "quality": rng.uniform(1.5, 5)}
+
+
+# Users are named by a first name and their number, so each can log in
+# by name and every load test session acts as the user it drew
+def generate_user(rng, number):
+    return {"user_id": random_id(rng),
+            "name": f"{rng.choice(FIRST_NAMES)}{number}",
+            "password": PASSWORD,
+            "yelping_since": str(FIRST_REVIEW_DATE + timedelta(
+                days=rng.randrange(3650))),
+            "review_count": 0, "stars_total": 0, "useful": 0, "funny": 0,
+            "cool": 0, "fans": int(rng.paretovariate(1.5)) - 1}
+
+
+def generate_reviews(seed, plans, business_docs, user_docs):
+    # A separate generator, so that the reviews come out the same however
+    # far the caller consumes them
+    rng = random.Random(f"{seed}:reviews")
+    for business, user, stars, (useful, funny, cool), day in plans:
+        words = min(MAX_REVIEW_WORDS, max(3, int(rng.lognormvariate(
+            0, 0.8) * MEAN_REVIEW_WORDS)))
+        yield {"review_id": random_id(rng),
+               "user_id": user_docs[user]["user_id"],
+               "business_id": business_docs[business]["business_id"],
+               "stars": stars, "useful": useful, "funny": funny,
+               "cool": cool, "date": str(day),
+               "text": " ".join(rng.choices(WORDS, k=words)).capitalize()
+               + "."}
+
+
+# Draws k indexes from range(n), with index i drawn in proportion to
+# 1 / (i + 1) ** ZIPF_EXPONENT
+def zipf_choices(rng, n, k):
+    weights = itertools.accumulate(1 / rank ** ZIPF_EXPONENT
+                                   for rank in range(1, n + 1))
+    return rng.choices(range(n), cum_weights=list(weights), k=k)
+
+
+def random_id(rng):
+    return "".join(rng.choice(string.ascii_letters + string.digits + "-_")
+                   for _ in range(22))
+
+
+# Writes a dataset as business.json, user.json and review.json in the
+# given directory, ready for the load command
+def write_dataset(directory, dataset):
+    os.makedirs(directory, exist_ok=True)
+    for collection in LOAD_ORDER:
+        with open(os.path.join(directory, f"{collection}.json"), "w") \
+                as file:
+            for record in dataset[collection]:
+                file.write(json.dumps(record) + "\n")
+
+
+# Inserts a dataset into a database the way the loader would, then builds
+# the indexes and leaderboards the queries read from
+def insert_dataset(db, dataset, batch_size=1000):
+    counts = {}
+    for collection in LOAD_ORDER:
+        counts[collection] = 0
+        records = (normalize(collection, record)
+                   for record in dataset[collection])
+        for batch in batches(records, batch_size):
+            counts[collection] += insert_batch(db[collection], batch)
+    ensure_indexes(db, wait=True)
+    refresh_leaderboards(db)
+    return counts
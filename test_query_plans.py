@@ -0,0 +1,97 @@
+# ----------------------------------------------------------------------
+# Name:        test_query_plans
+# Purpose:     Checks against a real MongoDB server that every numbered
+#              query is served from the indexes, and that the commands
+#              check-plans explains are the ones the service sends. The
+#              tests fill a scratch database with synthetic data and
+#              only run when REVIEWS_TEST_URI names a server.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+from pymongo import MongoClient, monitoring
+import os
+
+import bson
+import pytest
+
+from reviews_service import (ReviewsService, numbered_query_plans,
+                             plan_problems)
+from synthetic import generate_dataset, insert_dataset
+
+TEST_URI = os.environ.get("REVIEWS_TEST_URI")
+TEST_DATABASE = "reviews_test_query_plans"
+COMPARED_FIELDS = ("filter", "projection", "sort", "limit", "pipeline")
+
+pytestmark = pytest.mark.skipif(
+    not TEST_URI, reason="set REVIEWS_TEST_URI to a MongoDB server's URI")
+
+
+# Keeps the find and aggregate commands sent to the server
+class CommandLog(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        if event.command_name in ("find", "aggregate"):
+            self.commands.append(event.command)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@pytest.fixture(scope="module")
+def log():
+    return CommandLog()
+
+
+@pytest.fixture(scope="module")
+def db(log):
+    client = MongoClient(TEST_URI, event_listeners=[log])
+    client.drop_database(TEST_DATABASE)
+    db = client[TEST_DATABASE]
+    insert_dataset(db, generate_dataset(businesses=300, users=1000,
+                                        reviews=5000))
+    yield db
+    client.drop_database(TEST_DATABASE)
+    client.close()
+
+
+# The parts of a command that decide its plan, encoded so that commands
+# built from equal values compare equal
+def plan_fields(command):
+    return bson.encode({field: command[field] for field in COMPARED_FIELDS
+                        if field in command})
+
+
+def test_numbered_queries_use_indexes(db):
+    failures = {}
+    for label, command, may_sort in numbered_query_plans(db):
+        problems = plan_problems(db, command, may_sort)
+        if problems:
+            failures[label] = problems
+    assert failures == {}
+
+
+def test_explained_commands_are_the_ones_sent(db, log):
+    plans = {label: command
+             for label, command, _ in numbered_query_plans(db)}
+    business = db.business.find_one()
+    service = ReviewsService(db, cache_ttl=0)
+    location = {"city": business["city"], "state": business["state"]}
+    for label, call in (
+            ("Query 4 (city & state)",
+             lambda: service.search_businesses(location,
+                                               name=business["name"])),
+            ("Query 6 (city & state)",
+             lambda: service.search_businesses(location,
+                                               rating=business["stars"])),
+            ("Query 12",
+             lambda: service.business_reviews(business["business_id"]))):
+        log.commands.clear()
+        call()
+        assert plan_fields(plans[label]) in map(plan_fields, log.commands), \
+            label
+    service.close()
@@ -0,0 +1,76 @@
+# ----------------------------------------------------------------------
+# Name:        vote_buffer
+# Purpose:     Collects the votes cast on reviews in memory and hands
+#              them over in batches, summed per review, so that a review
+#              receiving many votes costs one increment per flush rather
+#              than one contended write per vote.
+#
+# Authors: Kenny Nguyen, Richard Ma, Brandon Palomino
+# ----------------------------------------------------------------------
+import threading
+
+VOTE_FLUSH_SIZE = 500  # reviews and authors pending before a flush
+VOTE_FLUSH_INTERVAL = 2  # seconds between background flushes
+
+
+# Sums votes until flushed, both by review and by the review's author.
+# write is called with a dict of ("review", review_id) and
+# ("user", user_id) keys to a dict of vote kind to count, and removes
+# the entries it has written; whatever is left if it raises is kept for
+# the next flush, so no vote is applied twice. Flushes happen once
+# VOTE_FLUSH_SIZE reviews and authors have pending votes, every
+# VOTE_FLUSH_INTERVAL seconds on a background thread, and on close.
+class VoteBuffer:
+    def __init__(self, write, flush_size=VOTE_FLUSH_SIZE,
+                 flush_interval=VOTE_FLUSH_INTERVAL):
+        self.write = write
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        # Serializes flushes, so that votes kept after a failed write are
+        # never written twice
+        self.flushing = threading.Lock()
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    def add(self, review, vote):
+        with self.lock:
+            for key in (("review", review["review_id"]),
+                        ("user", review["user_id"])):
+                votes = self.pending.setdefault(key, {})
+                votes[vote] = votes.get(vote, 0) + 1
+            full = len(self.pending) >= self.flush_size
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.flush_regularly,
+                                                daemon=True)
+                self.flusher.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flushing:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            try:
+                self.write(pending)
+            except Exception:
+                with self.lock:
+                    for key, votes in pending.items():
+                        kept = self.pending.setdefault(key, {})
+                        for vote, count in votes.items():
+                            kept[vote] = kept.get(vote, 0) + count
+                raise
+
+    def flush_regularly(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as error:
+                print(f"Flushing votes failed, will retry: {error!r}")
+
+    def close(self):
+        self.stopped.set()
+        self.flush()